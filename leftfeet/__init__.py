@@ -19,6 +19,7 @@ This is the module that interacts with the Rhythmbox plugin API.
 '''
 
 from gi.repository import GObject, GLib, Gio, Gtk, RB, Peas
+import os
 import sys
 import random
 import gettext
@@ -28,13 +29,52 @@ if sys.version_info.major >= 3:
 else:
     import anydbm as dbm
 import time
+import threading
+import itertools
+import json
+import collections
 
 from . import generator
+from . import library
+from . import index
+from . import replay
 __path__.insert(0, RB.user_data_dir())  # Allows user to override location
 from . import lf_site
 
 gettext.install('rhythmbox', RB.locale_dir())
 
+# Set LEFTFEET_STATS in the environment to log instrumentation for each generation
+collect_stats = bool(os.environ.get('LEFTFEET_STATS'))
+# Set LEFTFEET_TRACE to a file name to record each generation there, for replay.py
+trace_path = os.environ.get('LEFTFEET_TRACE')
+
+def debug(text):
+    '''
+    Write a (possibly multi-line) message to the debug log.
+    '''
+    for line in text.splitlines():
+        sys.stderr.write('leftfeet: ' + line + '\n')
+
+# Response emitted by the configuration dialog when a generation stops
+RESPONSE_DONE = 1
+# Response for the button that continues the last generation
+RESPONSE_EXTEND = 2
+# Duration of uncommitted songs kept by the stream in endless mode (seconds)
+STREAM_HORIZON = 3600
+# Time spent improving each chunk with generator.Generator.refine, if the
+# user has asked for it (seconds)
+REFINE_BUDGET = 0.5
+# Time after which no more trials are started when generating best-of-K (seconds)
+TRIALS_BUDGET = 10.0
+# Number of entries written to the library index per idle callback when resynchronising
+SYNC_BATCH = 1000
+# Delay before changes to the library index are saved (seconds)
+INDEX_COMMIT_DELAY = 5
+# Number of songs added to the play queue per idle callback
+ENQUEUE_BATCH = 25
+# Delay before changes to the settings are saved (seconds)
+SETTINGS_FLUSH_DELAY = 2
+
 ui_str = """
 <ui>
   <menubar name="MenuBar">
@@ -47,47 +87,534 @@ ui_str = """
 </ui>
 """
 
-class SongFactory(object):
+def entry_properties(entry):
+    '''
+    Read the properties of an entry that are kept in the library index, in
+    the order given by :py:data:`index.COLUMNS`.
     '''
-    Provides the factory for :py:func:`generator.generate_songs`.
+    return (entry.get_string(RB.RhythmDBPropType.LOCATION),
+            entry.get_string(RB.RhythmDBPropType.GENRE),
+            entry.get_ulong(RB.RhythmDBPropType.DURATION),
+            entry.get_double(RB.RhythmDBPropType.RATING),
+            entry.get_ulong(RB.RhythmDBPropType.LAST_PLAYED),
+            entry.get_ulong(RB.RhythmDBPropType.BITRATE),
+            entry.is_lossless(),
+            entry.get_ulong(RB.RhythmDBPropType.PLAY_COUNT))
 
-    :ivar dict songs: list of valid songs for each genre
-    :ivar list missing: genres we were asked for but could not provide
+def snapshot_entry(snapshot, entry, now = None):
     '''
-    def __init__(self, shell):
-        self.songs = {g: [] for g in lf_site.genres}
-        self.missing = []
+    Read the properties of an entry and add it to a snapshot. The entry is
+    recorded in the snapshot by its location.
 
+    :param snapshot: snapshot to add to
+    :type snapshot: :py:class:`library.Snapshot`
+    :param `RB.RhythmDB.Entry` entry: entry to add
+    :param now: if not `None`, the entry is only added if it passes
+      :py:func:`lf_site.valid_song` and has at least one genre
+    :return: the index of the entry in the snapshot, or `None` if it was rejected
+    '''
+    location, genre, duration, rating, last_played, bitrate, lossless, play_count = entry_properties(entry)
+    if hasattr(lf_site, 'classify'):
+        genres = lf_site.classify(genre)
+    else:
+        # Site file predating classify
+        genres = lf_site.get_genres(entry)
+    if now is not None:
+        if not genres:
+            return None
+        if hasattr(lf_site, 'valid_song'):
+            if not lf_site.valid_song(rating, last_played, bitrate, lossless, now):
+                return None
+        elif not lf_site.valid_entry(entry, now):
+            return None
+    return snapshot.add(location, duration, rating, last_played, bitrate, lossless, genres, play_count)
+
+class SongFactory(library.Factory):
+    '''
+    Provides the factory for :py:func:`generator.generate_songs`. The
+    candidates are read once, on construction, into a
+    :py:class:`library.Snapshot`, and songs are indices into it. The
+    candidates come from the library index if it has been synchronised at
+    least once, and otherwise from a scan of the whole library. If the site configuration has
+    :py:func:`lf_site.song_weight`, songs are drawn in proportion to it.
+
+    :ivar list prefix: indices of the songs already in the play queue
+    '''
+    def __init__(self, shell, library_index = None, rng = random):
+        '''
+        :param shell: the Rhythmbox shell
+        :param library_index: index to read the candidates from
+        :type library_index: :py:class:`index.LibraryIndex`
+        :param rng: source of random numbers for choosing songs
+        '''
+        snapshot = library.Snapshot()
         lib = shell.props.library_source.props.base_query_model
         queue = shell.props.queue_source.props.base_query_model
-        now = time.time() # Cache it for valid_entry
+        now = time.time() # Cache it for valid_song
+        self.db = shell.props.db
 
-        for row in lib:
-            entry = row[0]
+        self.prefix = [snapshot_entry(snapshot, row[0]) for row in queue]
+        if (library_index is not None and library_index.synced
+                and hasattr(lf_site, 'classify') and hasattr(lf_site, 'valid_song')):
             # Avoid anything in the play queue
-            it = Gtk.TreeIter()
-            if not queue.entry_to_iter(entry, it):
-                if lf_site.valid_entry(entry, now):
-                    genres = lf_site.get_genres(entry)
-                    for g in genres:
-                        self.songs[g].append(entry)
-
-    def get(self, genre):
-        if genre in self.songs and self.songs[genre]:
-            entry = random.choice(self.songs[genre])
-            # Avoid picking it again (TODO: use an index to speed this up)
-            for g in self.get_genres(entry):
-                self.songs[g].remove(entry)
-            return entry
+            exclude = set(snapshot.entries)
+            candidates = library_index.load(snapshot, lf_site.classify, lf_site.valid_song, now, exclude)
         else:
-            self.missing.append(genre)
-            return None
+            candidates = []
+            for row in lib:
+                entry = row[0]
+                # Avoid anything in the play queue
+                it = Gtk.TreeIter()
+                if not queue.entry_to_iter(entry, it):
+                    index = snapshot_entry(snapshot, entry, now)
+                    if index is not None:
+                        candidates.append(index)
+
+        weight = None
+        if hasattr(lf_site, 'song_weight'):
+            def weight(index):
+                return lf_site.song_weight(snapshot.ratings[index], snapshot.play_counts[index],
+                                           snapshot.last_played[index], now)
+        super(SongFactory, self).__init__(snapshot, candidates, rng, weight)
+
+    def entry(self, index):
+        '''
+        Map a song returned by :py:meth:`get` back to the Rhythmbox entry.
 
-    def get_duration(self, entry):
-        return entry.get_ulong(RB.RhythmDBPropType.DURATION)
+        :return: the entry, or `None` if it is no longer in the library
+        '''
+        return self.db.entry_lookup_by_location(self.snapshot.entries[index])
+
+class Session(object):
+    '''
+    The state at the end of a generation, kept so that the play queue can
+    later be extended where the generation left off (see
+    :py:meth:`generator.Generator.get_state`). The factory is kept along with
+    it, so that extending does not need to read the library again.
 
-    def get_genres(self, entry):
-        return lf_site.get_genres(entry)
+    :ivar factory: the factory used by the generation
+    :vartype factory: :py:class:`SongFactory`
+    :ivar dict state: the state of the generator and of the factory
+    :ivar list locations: locations of the songs at the end of the queue
+      that the generator remembers
+    '''
+    def __init__(self, gen):
+        self.factory = gen.factory
+        self.state = {
+            'generator': gen.get_state(lf_site.genres),
+            'factory': self.factory.get_state(lf_site.genres)
+        }
+        self.locations = [self.factory.snapshot.entries[song] for song in gen.recent]
+
+    def matches(self, shell):
+        '''
+        Whether the play queue still ends with the songs that the session
+        ended with. Songs that have since been played and left the queue do
+        not matter.
+        '''
+        queue = [row[0].get_string(RB.RhythmDBPropType.LOCATION)
+                 for row in shell.props.queue_source.props.base_query_model]
+        n = min(len(queue), len(self.locations))
+        return n > 0 and queue[-n:] == self.locations[-n:]
+
+    def restore(self, stats = None):
+        '''
+        Return a generator that continues from the session. The factory is
+        reset to its state at the end of the session, even if a previous
+        attempt to extend it was cancelled.
+        '''
+        self.factory.set_state(self.state['factory'], lf_site.genres)
+        gen = generator.Generator.restore(self.state['generator'], lf_site.genres, lf_site.repel,
+                                          self.factory, stats = stats)
+        self.factory.rng = gen.rng
+        return gen
+
+class GenerateJob(object):
+    '''
+    Runs a :py:class:`generator.Generator` in a worker thread. The worker only
+    touches the generator and its factory, which are independent of
+    Rhythmbox; everything else happens in callbacks scheduled on the main loop
+    with :py:func:`GLib.idle_add`.
+
+    Songs are committed in chunks of roughly :py:attr:`chunk` seconds, and each
+    chunk is handed to `on_chunk` as soon as it is final, so the play queue
+    starts to fill before generation is complete. If `refine` is given, each
+    chunk is refined for that many seconds before it is committed.
+
+    :ivar gen: the generator
+    :vartype gen: :py:class:`generator.Generator`
+    :ivar factory: the generator's factory
+    :vartype factory: :py:class:`SongFactory`
+    :ivar duration: total duration to generate
+    :ivar stats: timing for the run, which is recorded in the `generate` phase
+    :vartype stats: :py:class:`generator.Stats`
+    :ivar refine: time to spend refining each chunk (seconds), or 0 to not refine
+    '''
+    chunk = 900
+
+    def __init__(self, gen, duration, stats, on_chunk, on_progress, on_done, refine = 0):
+        '''
+        :param gen: generator to run
+        :param duration: duration to target (seconds)
+        :param stats: where to record the time taken
+        :param on_chunk: called with a list of committed songs
+        :param on_progress: called with the fraction of the duration generated so far
+        :param on_done: called once the worker has stopped, whether it finished or was cancelled
+        :param refine: time to spend refining each chunk (seconds), or 0 to not refine
+        '''
+        self.gen = gen
+        self.refine = refine
+        self.factory = gen.factory if gen is not None else None
+        self.duration = duration
+        self.stats = stats
+        self.on_chunk = on_chunk
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target = self._run, name = 'leftfeet-generate')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def cancelled(self):
+        '''
+        Whether :py:meth:`cancel` has been called.
+        '''
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        '''
+        Ask the worker to stop. Songs that have not yet been committed are
+        discarded. `on_done` is still called once the worker stops.
+        '''
+        self._cancelled.set()
+
+    def _run(self):
+        try:
+            with self.stats.phase('generate'):
+                self._generate()
+        finally:
+            GLib.idle_add(self.on_done)
+
+    def _generate(self):
+        gen = self.gen
+        reported = 0.0
+        target = 0
+        exhausted = False
+        while not exhausted and gen.duration < self.duration:
+            target = min(target + self.chunk, self.duration)
+            while gen.duration < target:
+                if self._cancelled.is_set():
+                    return
+                if gen.step() is None:
+                    exhausted = True
+                    break
+                fraction = min(1.0, float(gen.duration) / self.duration)
+                if fraction - reported >= 0.01:
+                    reported = fraction
+                    GLib.idle_add(self.on_progress, fraction)
+            if self.refine:
+                with self.stats.phase('refine'):
+                    gen.refine(self.refine)
+            GLib.idle_add(self.on_chunk, gen.commit())
+
+class BestOfJob(GenerateJob):
+    '''
+    Variant of :py:class:`GenerateJob` that uses
+    :py:func:`generator.generate_best`. The best queue is only known once all
+    trials are done, so it is handed to `on_chunk` in one go, and progress is
+    only reported at the end.
+    '''
+    def __init__(self, freqs, factory, duration, trials, stats, on_chunk, on_progress, on_done):
+        super(BestOfJob, self).__init__(None, duration, stats, on_chunk, on_progress, on_done)
+        self.freqs = freqs
+        self.factory = factory
+        self.trials = trials
+
+    def _generate(self):
+        # The worker processes are stopped as soon as the job is cancelled
+        songs = generator.generate_best(
+            self.freqs, lf_site.repel, self.duration, self.factory, self.factory.prefix,
+            trials = self.trials, budget = TRIALS_BUDGET, rng = self.factory.rng,
+            cancelled = self._cancelled.is_set)
+        if songs is not None and not self._cancelled.is_set():
+            GLib.idle_add(self.on_progress, 1.0)
+            GLib.idle_add(self.on_chunk, songs)
+
+class StreamJob(object):
+    '''
+    Keeps the play queue filled from :py:func:`generator.stream_songs`. As in
+    :py:class:`GenerateJob`, songs are drawn from the stream in a worker
+    thread, which only touches the stream and its factory. They are then
+    added to the queue by an :py:class:`Enqueuer`, after which the queue is
+    checked again, in case some of the songs had left the library.
+
+    :ivar factory: the stream's factory
+    :vartype factory: :py:class:`SongFactory`
+    :ivar int lookahead: duration of music to keep in the queue (seconds)
+    '''
+    def __init__(self, shell, songs, factory, lookahead, on_exhausted):
+        '''
+        :param shell: the Rhythmbox shell
+        :param songs: the stream
+        :param factory: the stream's factory
+        :param int lookahead: duration of music to keep in the queue (seconds)
+        :param on_exhausted: called once the stream has run out and its last
+          songs have been added, unless the job was cancelled first
+        '''
+        self.shell = shell
+        self.songs = songs
+        self.factory = factory
+        self.lookahead = lookahead
+        self.on_exhausted = on_exhausted
+        self._cancelled = threading.Event()
+        self._running = False
+        self.enqueuer = Enqueuer(shell, factory, self.cancelled)
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        '''
+        Stop topping up. Songs that have been drawn but not yet added are
+        dropped.
+        '''
+        self._cancelled.set()
+
+    def top_up(self):
+        '''
+        Start drawing songs in the background if the queue holds less than
+        :py:attr:`lookahead`. If songs are already being drawn or added, the
+        queue is checked once they have been.
+        '''
+        if self.cancelled() or self._running or self.enqueuer.busy():
+            return
+        queue = self.shell.props.queue_source.props.base_query_model
+        remaining = sum(row[0].get_ulong(RB.RhythmDBPropType.DURATION) for row in queue)
+        if remaining < self.lookahead:
+            self._running = True
+            thread = threading.Thread(target = self._run, args = (self.lookahead - remaining,),
+                                      name = 'leftfeet-stream')
+            thread.daemon = True
+            thread.start()
+
+    def _run(self, needed):
+        songs = []
+        exhausted = False
+        while needed > 0 and not self._cancelled.is_set():
+            song = next(self.songs, None)
+            if song is None:
+                exhausted = True
+                break
+            songs.append(song)
+            needed -= self.factory.get_duration(song)
+        GLib.idle_add(self._drawn, songs, exhausted)
+
+    def _drawn(self, songs, exhausted):
+        self._running = False
+        if not self.cancelled():
+            self.enqueuer.add(songs)
+            self.enqueuer.when_idle(lambda: self._added(exhausted))
+        return False
+
+    def _added(self, exhausted):
+        if self.cancelled():
+            return
+        if exhausted:
+            self.on_exhausted()
+        else:
+            self.top_up()
+
+def _text(value):
+    '''
+    Convert a key or value read from the settings database to a string.
+    '''
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+class Settings(object):
+    '''
+    The settings database, held in memory. Reads never touch the database,
+    and writes are saved :py:data:`SETTINGS_FLUSH_DELAY` seconds after the
+    last change, so that dragging a slider does not write to disk on every
+    step. :py:meth:`flush` saves pending changes immediately.
+
+    Keys and values are strings. Named presets of genre frequencies are
+    stored one per record, under `preset.` followed by the name, so that
+    loading one is a single read.
+
+    :ivar db: the underlying database, as returned by :py:func:`dbm.open`
+    '''
+    def __init__(self, db):
+        self.db = db
+        self._values = {_text(key): _text(db[key]) for key in db.keys()}
+        self._dirty = set()
+        self._flush_source = None
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+        self._dirty.add(key)
+        self._schedule_flush()
+
+    def __delitem__(self, key):
+        del self._values[key]
+        self._dirty.add(key)
+        self._schedule_flush()
+
+    def get(self, key, default = None):
+        return self._values.get(key, default)
+
+    def _schedule_flush(self):
+        if self._flush_source is not None:
+            GLib.source_remove(self._flush_source)
+        self._flush_source = GLib.timeout_add_seconds(SETTINGS_FLUSH_DELAY, self._flush_timeout)
+
+    def _flush_timeout(self):
+        self._flush_source = None
+        self.flush()
+        return False
+
+    def flush(self):
+        '''
+        Write pending changes to the database.
+        '''
+        if self._flush_source is not None:
+            GLib.source_remove(self._flush_source)
+            self._flush_source = None
+        for key in self._dirty:
+            if key in self._values:
+                self.db[key] = self._values[key]
+            elif key in self.db:
+                del self.db[key]
+        self._dirty.clear()
+        if hasattr(self.db, 'sync'):
+            self.db.sync()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def presets(self):
+        '''
+        Return the names of the saved presets, in sorted order.
+        '''
+        return sorted(key[len('preset.'):] for key in self._values if key.startswith('preset.'))
+
+    def load_preset(self, name):
+        '''
+        Return a saved preset, as a dictionary mapping genre names to
+        frequencies, or `None` if there is no preset called `name`.
+        '''
+        value = self._values.get('preset.' + name)
+        return json.loads(value) if value is not None else None
+
+    def save_preset(self, name, freqs):
+        '''
+        Save a preset, replacing any existing preset with the same name.
+
+        :param str name: name of the preset
+        :param dict freqs: map from genre name to frequency
+        '''
+        self['preset.' + name] = json.dumps(freqs, sort_keys = True)
+
+    def delete_preset(self, name):
+        if 'preset.' + name in self._values:
+            del self['preset.' + name]
+
+class Enqueuer(object):
+    '''
+    Appends songs to the play queue in batches of :py:data:`ENQUEUE_BATCH`
+    on idle callbacks, so that adding hundreds of songs does not block the
+    user interface. Rhythmbox has no way to add several entries at once, so
+    each song is still added individually, but the queue view gets to
+    redraw between batches.
+
+    Songs are added in the order they were passed to :py:meth:`add`. If
+    `cancelled` becomes true, songs not yet added are dropped, so the queue
+    always ends with a prefix of what was generated.
+
+    :ivar int added: number of songs added so far
+    :ivar int total: number of songs passed to :py:meth:`add` so far
+    '''
+    def __init__(self, shell, factory, cancelled = lambda: False, on_progress = None, stats = None):
+        '''
+        :param shell: the Rhythmbox shell
+        :param factory: maps songs to entries
+        :type factory: :py:class:`SongFactory`
+        :param cancelled: function that returns true once the songs that have
+          not been added should be dropped
+        :param on_progress: called with the number of songs added and the
+          total after each batch
+        :param stats: if given, the time spent adding songs is recorded in its
+          `enqueue` phase
+        :type stats: :py:class:`generator.Stats`
+        '''
+        self.shell = shell
+        self.factory = factory
+        self.cancelled = cancelled
+        self.on_progress = on_progress
+        self.stats = stats
+        self.added = 0
+        self.total = 0
+        self._pending = collections.deque()
+        self._source = None
+        self._on_idle = None
+
+    def add(self, songs):
+        '''
+        Schedule songs to be appended to the queue, after any already scheduled.
+        '''
+        self._pending.extend(songs)
+        self.total += len(songs)
+        if self._source is None and self._pending:
+            self._source = GLib.idle_add(self._step)
+
+    def busy(self):
+        return self._source is not None
+
+    def when_idle(self, callback):
+        '''
+        Call `callback` (with no arguments) once there is nothing left to
+        add, or immediately if there is nothing to add now.
+        '''
+        if self.busy():
+            self._on_idle = callback
+        else:
+            callback()
+
+    def _add_batch(self):
+        queue_source = self.shell.props.queue_source
+        for _i in range(min(ENQUEUE_BATCH, len(self._pending))):
+            entry = self.factory.entry(self._pending.popleft())
+            if entry is not None:
+                queue_source.add_entry(entry, -1)
+            self.added += 1
+
+    def _step(self):
+        if self.cancelled():
+            self._pending.clear()
+        if self.stats is not None:
+            with self.stats.phase('enqueue'):
+                self._add_batch()
+        else:
+            self._add_batch()
+        if self.on_progress is not None and not self.cancelled():
+            self.on_progress(self.added, self.total)
+        if self._pending:
+            return True
+        self._source = None
+        if self._on_idle is not None:
+            callback, self._on_idle = self._on_idle, None
+            callback()
+        return False
 
 class ConfigDialog(Gtk.Dialog):
     '''
@@ -95,14 +622,29 @@ class ConfigDialog(Gtk.Dialog):
 
     :ivar Gtk.Adjustment duration_minutes: adjustment holding the length of time to generate over
     :ivar dict freqs: dictionary mapping :py:class:`leftfeet.genre.Genre` objects to GTK adjustments for relative frequencies
+    :ivar Gtk.CheckButton endless: whether to keep topping up the queue rather than generating a fixed duration
+    :ivar Gtk.Adjustment trials: adjustment holding the number of independent trials to pick the best of
+    :ivar Gtk.CheckButton refine: whether to spend extra time improving the order of the songs
     :ivar settings: settings database
+    :vartype settings: :py:class:`Settings`
+    :ivar Gtk.ComboBoxText preset: name of the preset to load, save or delete
     '''
-    def __init__(self, parent, settings):
+    def __init__(self, parent, settings, endless = False, extend = False):
+        '''
+        :param parent: parent window
+        :param settings: settings database
+        :param bool endless: initial state of the :py:attr:`endless` button
+        :param bool extend: whether to offer to continue the last generation
+        '''
         Gtk.Dialog.__init__(self,
             title = 'LeftFeet configuration',
             transient_for = parent,
             modal = True,
             destroy_with_parent = True)
+        if extend:
+            button = self.add_button(_('Extend'), RESPONSE_EXTEND)
+            button.set_tooltip_text(
+                _('Add this many minutes, continuing the last generation with its frequencies'))
         self.add_buttons(
             Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
             Gtk.STOCK_OK, Gtk.ResponseType.OK
@@ -116,6 +658,20 @@ class ConfigDialog(Gtk.Dialog):
         vbox = Gtk.VBox()
         self.get_content_area().add(vbox)
 
+        preset_box = Gtk.HBox()
+        vbox.pack_start(preset_box, False, False, 5)
+        preset_box.pack_start(Gtk.Label(label = _('Preset')), False, False, 5)
+        self.preset = Gtk.ComboBoxText.new_with_entry()
+        self.fill_presets()
+        self.preset.connect('changed', self.preset_changed)
+        preset_box.pack_start(self.preset, True, True, 5)
+        save_button = Gtk.Button(label = _('Save'))
+        save_button.connect('clicked', self.save_preset)
+        preset_box.pack_start(save_button, False, False, 5)
+        delete_button = Gtk.Button(label = _('Delete'))
+        delete_button.connect('clicked', self.delete_preset)
+        preset_box.pack_start(delete_button, False, False, 5)
+
         freq_frame = Gtk.Frame()
         freq_frame.set_label('Relative Frequency')
         vbox.pack_start(freq_frame, False, False, 5)
@@ -152,9 +708,57 @@ class ConfigDialog(Gtk.Dialog):
         spinner.set_value(self.duration_minutes.get_value())
         hbox.pack_start(spinner, True, True, 5)
 
+        self.endless = Gtk.CheckButton(
+            label = _('Keep the queue filled this many minutes ahead'),
+            active = endless)
+        vbox.pack_start(self.endless, False, False, 5)
+
+        hbox = Gtk.HBox()
+        vbox.pack_start(hbox, False, False, 5)
+        hbox.pack_start(Gtk.Label(label = _('Trials')), False, False, 5)
+        self.trials = Gtk.Adjustment(
+            value = float(self.settings['trials']) if 'trials' in self.settings else 1,
+            lower = 1, upper = 32, step_increment = 1, page_increment = 4)
+        self.trials.connect('value-changed', self.trials_changed)
+        trials_spinner = Gtk.SpinButton()
+        trials_spinner.set_adjustment(self.trials)
+        trials_spinner.set_digits(0)
+        trials_spinner.set_tooltip_text(_('Generate several queues in parallel and keep the best'))
+        hbox.pack_start(trials_spinner, True, True, 5)
+
+        self.refine = Gtk.CheckButton(
+            label = _('Spend extra time improving the order'),
+            active = self.settings.get('refine') == '1')
+        self.refine.set_tooltip_text(
+            _('Rearrange each part of the queue for a short time before adding it'))
+        self.refine.connect('toggled', self.refine_toggled)
+        vbox.pack_start(self.refine, False, False, 5)
+        self.controls = [preset_box, grid, spinner, self.endless, trials_spinner, self.refine]
+
+        self.progress = Gtk.ProgressBar(show_text = True, margin = 5, no_show_all = True)
+        vbox.pack_start(self.progress, False, False, 5)
+
         self.set_default_size(500, -1)
         self.show_all()
 
+    def set_running(self, running):
+        '''
+        Switch between accepting settings and showing the progress of a
+        generation. While running, only the cancel button is active.
+        '''
+        for widget in self.controls:
+            widget.set_sensitive(not running)
+        self.set_response_sensitive(Gtk.ResponseType.OK, not running)
+        self.set_response_sensitive(RESPONSE_EXTEND, not running)
+        self.progress.set_fraction(0.0)
+        self.progress.set_text(_('Generating'))
+        self.progress.set_visible(running)
+
+    def set_progress(self, fraction, text = None):
+        self.progress.set_fraction(fraction)
+        if text is not None:
+            self.progress.set_text(text)
+
     def freq_changed(self, adj, genre):
         '''
         Callback for a change in a frequency slider. This updates the
@@ -166,6 +770,42 @@ class ConfigDialog(Gtk.Dialog):
         '''
         self.settings['freq.' + genre.name] = repr(adj.get_value())
 
+    def trials_changed(self, adj):
+        self.settings['trials'] = repr(adj.get_value())
+
+    def refine_toggled(self, button):
+        self.settings['refine'] = '1' if button.get_active() else '0'
+
+    def preset_changed(self, combo):
+        '''
+        Callback for a change in the preset combo box. Choosing a saved
+        preset from the list sets the frequency sliders from it; typing a
+        name has no effect until the preset is saved.
+        '''
+        if combo.get_active() < 0:
+            return
+        freqs = self.settings.load_preset(combo.get_active_text())
+        if freqs is not None:
+            for g, adj in self.adjustments.items():
+                if g.name in freqs:
+                    adj.set_value(freqs[g.name])
+
+    def fill_presets(self):
+        self.preset.remove_all()
+        for name in self.settings.presets():
+            self.preset.append_text(name)
+
+    def save_preset(self, button):
+        name = self.preset.get_active_text().strip()
+        if name:
+            self.settings.save_preset(name, {g.name: adj.get_value() for g, adj in self.adjustments.items()})
+            self.fill_presets()
+
+    def delete_preset(self, button):
+        self.settings.delete_preset(self.preset.get_active_text())
+        self.fill_presets()
+        self.preset.get_child().set_text('')
+
 class LeftFeetPlugin(GObject.Object, Peas.Activatable):
     '''
     Plugin class
@@ -177,24 +817,91 @@ class LeftFeetPlugin(GObject.Object, Peas.Activatable):
 
     def __init__(self):
         super(LeftFeetPlugin, self).__init__()
+        self.stream = None
+        self.session = None
+        self.index = None
+        self.sync_source = None
+        self.commit_source = None
 
-    def generate(self, freqs, duration):
+    def start_sync(self, *args):
+        '''
+        Resynchronise the library index with the library, in batches on
+        idle callbacks. This is also the handler for the `load-complete`
+        signal of the database.
         '''
-        Generate the list of songs and enqueue them to the play queue.
+        shell = self.object
+        if self.index is None:
+            return False     # Deactivated in the meantime
+        if not args and shell.props.db.is_busy():
+            # Still loading, so the library is incomplete. The sync starts on
+            # load-complete instead, rather than pruning the index now.
+            return False
+        if self.sync_source is not None:
+            GLib.source_remove(self.sync_source)
+        entries = [row[0] for row in shell.props.library_source.props.base_query_model]
+        self.index.begin_sync()
+        self.sync_source = GLib.idle_add(self.sync_step, iter(entries))
+        return False
 
-        .. todo:: More intelligent random choice (consider star ratings etc)
-        .. todo:: Avoid picking songs that have been played recently
+    def sync_step(self, entries):
+        batch = [entry_properties(entry) for entry in itertools.islice(entries, SYNC_BATCH)]
+        self.index.update(batch)
+        if len(batch) < SYNC_BATCH:
+            self.index.end_sync()
+            self.sync_source = None
+            return False
+        return True
+
+    def is_song(self, entry):
+        return entry.get_entry_type() == self.object.props.library_source.props.entry_type
+
+    def entry_changed(self, db, entry, *args):
+        '''
+        Handler for the `entry-added` and `entry-changed` signals of the
+        database, which keeps the library index up to date.
+        '''
+        if self.is_song(entry):
+            if entry.get_boolean(RB.RhythmDBPropType.HIDDEN):
+                self.index.remove(entry.get_string(RB.RhythmDBPropType.LOCATION))
+            else:
+                self.index.update([entry_properties(entry)])
+            self.schedule_index_commit()
+
+    def entry_deleted(self, db, entry):
+        '''
+        Handler for the `entry-deleted` signal of the database.
+        '''
+        if self.is_song(entry):
+            self.index.remove(entry.get_string(RB.RhythmDBPropType.LOCATION))
+            self.schedule_index_commit()
+
+    def schedule_index_commit(self):
+        '''
+        Save changes to the library index after a short delay, so that a
+        burst of changes is written at once.
+        '''
+        if self.commit_source is None:
+            self.commit_source = GLib.timeout_add_seconds(INDEX_COMMIT_DELAY, self.commit_index)
+
+    def commit_index(self):
+        self.index.commit()
+        self.commit_source = None
+        return False
+
+    def start_stream(self, freqs, lookahead):
+        '''
+        Start keeping the play queue filled with songs from
+        :py:func:`generator.stream_songs`. The queue is topped up now, and
+        again each time the playing song changes.
 
         :param map freqs: map from genre to relation frequency
-        :param int duration: duration to target (seconds)
-        :return: `True` if generation was successful, `False` to redisplay the dialog
+        :param int lookahead: duration of music to keep in the queue (seconds)
+        :return: `True` if successful, `False` to redisplay the dialog
         '''
         shell = self.object
-        queue = shell.props.queue_source.props.base_query_model
-        prefix = [row[0] for row in queue]
-        factory = SongFactory(shell)
+        factory = SongFactory(shell, self.index)
         try:
-            songs = generator.generate_songs(freqs, lf_site.repel, duration, factory, prefix)
+            songs = generator.stream_songs(freqs, lf_site.repel, factory, factory.prefix, STREAM_HORIZON)
         except ValueError as e:
             message = Gtk.MessageDialog(
                     shell.props.window,
@@ -205,11 +912,139 @@ class LeftFeetPlugin(GObject.Object, Peas.Activatable):
             message.connect('response', lambda w, response: w.destroy())
             message.run()
             return False
+        def on_exhausted():
+            self.stop_stream()
+            self.report_missing(factory)
+
+        self.stream = StreamJob(shell, songs, factory, lookahead, on_exhausted)
+        self.stream.top_up()
+        return True
+
+    def stop_stream(self):
+        if self.stream is not None:
+            self.stream.cancel()
+            self.stream = None
+
+    def top_up(self, *args):
+        '''
+        Add songs from the stream in the background until the queue holds
+        enough music. This is also the handler for the `playing-song-changed`
+        signal.
+        '''
+        if self.stream is not None:
+            self.stream.top_up()
+
+    def generate(self, freqs, duration, dialog, trials = 1, session = None, refine = False):
+        '''
+        Start generating the list of songs in the background, enqueuing them to
+        the play queue as they are committed (see :py:class:`Enqueuer`).
+
+        .. todo:: Avoid picking songs that have been played recently
+
+        :param map freqs: map from genre to relation frequency
+        :param int duration: duration to target (seconds)
+        :param dialog: dialog to report progress to. It receives
+          :py:data:`RESPONSE_DONE` when generation stops and the songs
+          generated have been added to the queue. If the job is cancelled,
+          the queue is left holding a prefix of the songs generated.
+        :type dialog: :py:class:`ConfigDialog`
+        :param int trials: if more than one, generate this many queues in
+          parallel and keep the best (see :py:func:`generator.generate_best`)
+        :param session: if given, continue from this session rather than
+          starting afresh, in which case `freqs` and `trials` are ignored
+        :type session: :py:class:`Session`
+        :param bool refine: whether to refine each chunk for
+          :py:data:`REFINE_BUDGET` seconds (only for a single trial)
+        :return: the :py:class:`GenerateJob`, or `None` to redisplay the dialog
+        '''
+        shell = self.object
+        stats = generator.Stats()
+        gen_stats = stats if collect_stats else None
+        recorder = None
+        gen = None
+        if session is not None:
+            trials = 1
+            gen = session.restore(gen_stats)
+            factory = gen.factory
+        else:
+            rng = random.Random()
+            with stats.phase('scan'):
+                factory = SongFactory(shell, self.index, rng)
+            if trace_path and trials == 1:
+                # The replay does not draw songs, so the generator gets random
+                # numbers of its own, leaving the factory's out of the trace
+                recorder = replay.TraceRecorder(open(trace_path, 'w'), lf_site.genres, lf_site.repel,
+                                                freqs, factory, factory.prefix, duration = duration)
+                rng = recorder.rng
+            try:
+                if trials > 1:
+                    # BestOfJob makes its own generators, so only check the frequencies
+                    if sum(freqs.values()) <= 0.0:
+                        raise ValueError('Must have at least one non-zero frequency')
+                else:
+                    gen = generator.Generator(freqs, lf_site.repel, factory, factory.prefix,
+                                              stats = gen_stats, rng = rng, trace = recorder)
+            except ValueError as e:
+                if recorder is not None:
+                    recorder.close()
+                message = Gtk.MessageDialog(
+                        shell.props.window,
+                        Gtk.DialogFlags.DESTROY_WITH_PARENT | Gtk.DialogFlags.MODAL,
+                        Gtk.MessageType.ERROR,
+                        Gtk.ButtonsType.OK,
+                        str(e))
+                message.connect('response', lambda w, response: w.destroy())
+                message.run()
+                return None
+
+        def on_chunk(songs):
+            enqueuer.add(songs)
+            return False
+
+        def on_progress(fraction):
+            dialog.set_progress(fraction)
+            return False
+
+        def on_enqueued(added, total):
+            if not worker_running[0]:
+                dialog.set_progress(float(added) / total, _('Adding to play queue'))
+
+        def finish():
+            # Only a complete single generation leaves a queue that can be extended
+            if trials == 1 and not job.cancelled():
+                self.session = Session(gen)
+            else:
+                self.session = None
+            if collect_stats:
+                debug(stats.report())
+            if recorder is not None:
+                recorder.close()
+                debug('trace written to ' + trace_path)
+            dialog.response(RESPONSE_DONE)
+
+        def on_done():
+            # Songs may still be waiting to be added to the queue
+            worker_running[0] = False
+            enqueuer.when_idle(finish)
+            return False
 
-        missing_genres = set()
-        for song in songs:
-            shell.props.queue_source.add_entry(song, -1)
+        if trials > 1:
+            job = BestOfJob(freqs, factory, duration, trials, stats, on_chunk, on_progress, on_done)
+        else:
+            job = GenerateJob(gen, duration, stats, on_chunk, on_progress, on_done,
+                              REFINE_BUDGET if refine else 0)
+        enqueuer = Enqueuer(shell, factory, job.cancelled, on_enqueued, stats)
+        worker_running = [True]
+        dialog.set_running(True)
+        job.start()
+        return job
+
+    def report_missing(self, factory):
+        '''
+        Warn the user about genres that ran out of songs.
+        '''
         if factory.missing:
+            shell = self.object
             text = 'Could not find enough songs from the following genre(s):\n'
             for g in factory.missing:
                 text += g.name + '\n'
@@ -221,25 +1056,53 @@ class LeftFeetPlugin(GObject.Object, Peas.Activatable):
                     text)
             message.connect('response', lambda w, response: w.destroy())
             message.run()
-        return True
 
     def generate_action(self, action, parameter, shell):
         '''
         Display the *Generate play queue* dialog and handle the response.
+        While a generation is running, the dialog shows its progress, and
+        cancelling or closing it stops the generation. Accepting the dialog
+        also stops any stream started by :py:meth:`start_stream`.
+
+        If the play queue still ends where the last generation left off, the
+        dialog also offers to extend it from there (see :py:class:`Session`).
         '''
         shell = self.object
-        dialog = ConfigDialog(shell.props.window, self.settings)
+        if self.session is not None and not self.session.matches(shell):
+            self.session = None
+        dialog = ConfigDialog(shell.props.window, self.settings, self.stream is not None,
+                              self.session is not None)
 
-        done = False
-        while not done:
+        job = None
+        while True:
             response = dialog.run()
-            done = True
-            if response == Gtk.ResponseType.OK:
+            if job is not None:
+                if response == RESPONSE_DONE:
+                    break
+                # Wait for the worker to stop, so that the queue is consistent
+                job.cancel()
+            elif response == Gtk.ResponseType.OK:
                 freqs = {g: dialog.adjustments[g].get_value() for g in lf_site.genres}
                 duration = int(dialog.duration_minutes.get_value() * 60)
-                if not self.generate(freqs, duration):
-                    done = False
+                self.stop_stream()
+                if dialog.endless.get_active():
+                    if self.start_stream(freqs, duration):
+                        break
+                else:
+                    trials = int(dialog.trials.get_value())
+                    job = self.generate(freqs, duration, dialog, trials,
+                                        refine = dialog.refine.get_active())
+            elif response == RESPONSE_EXTEND:
+                duration = int(dialog.duration_minutes.get_value() * 60)
+                self.stop_stream()
+                job = self.generate(None, duration, dialog, session = self.session,
+                                    refine = dialog.refine.get_active())
+            else:
+                break
         dialog.destroy()
+        self.settings.flush()
+        if job is not None:
+            self.report_missing(job.factory)
 
     @classmethod
     def play_queue_data_func(cls, cell_layout, cell, model, it, data):
@@ -286,13 +1149,36 @@ class LeftFeetPlugin(GObject.Object, Peas.Activatable):
 
             shell.set_data('leftfeet', {'ui_id': ui_id, 'action_group': action_group})
 
-        self.settings = dbm.open(RB.find_user_data_file('leftfeet.db'), 'c')
+        self.settings = Settings(dbm.open(RB.find_user_data_file('leftfeet.db'), 'c'))
+        self.player_handler = shell.props.shell_player.connect('playing-song-changed', self.top_up)
+
+        # Songs added or removed while the plugin was inactive are picked up
+        # by resynchronising, both now and once the database has loaded
+        self.index = index.LibraryIndex(RB.find_user_data_file('leftfeet-index.sqlite'))
+        db = shell.props.db
+        self.db_handlers = [
+            db.connect('entry-added', self.entry_changed),
+            db.connect('entry-changed', self.entry_changed),
+            db.connect('entry-deleted', self.entry_deleted),
+            db.connect('load-complete', self.start_sync)
+        ]
+        GLib.idle_add(self.start_sync)
 
     def do_deactivate(self):
         '''
         Plugin deactivation
         '''
         shell = self.object
+        shell.props.shell_player.disconnect(self.player_handler)
+        for handler in self.db_handlers:
+            shell.props.db.disconnect(handler)
+        for source in [self.sync_source, self.commit_source]:
+            if source is not None:
+                GLib.source_remove(source)
+        self.sync_source = self.commit_source = None
+        self.index.close()
+        self.index = None
+        self.stop_stream()
         if hasattr(shell.props, 'application'):
             # Newer Rhythmbox
             app = shell.props.application
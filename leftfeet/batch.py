@@ -0,0 +1,259 @@
+# LeftFeet: generates a Rhythmbox play queue for social dancing
+# Copyright (C) 2014  Bruce Merry <bmerry@users.sourceforge.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import division, print_function
+
+'''
+Generates playlists for a series of events, such as every social in a term,
+while Rhythmbox is closed:
+
+    python batch.py events.json [--format xspf] [--exclusive]
+
+The songs are read once from the library index that the plugin keeps (see
+:py:mod:`index`), filtered and weighted by the rules in :py:mod:`lf_site`,
+and the events are then generated in parallel in a pool of worker
+processes, which share that snapshot. Each playlist is written as M3U or
+XSPF (see :py:mod:`playlist`).
+
+The events are described by a JSON file holding a list of objects with the
+following keys:
+
+- `name`: name of the event, which is also the name of the playlist file
+  (default `event-N`)
+- `duration`: length of the playlist in minutes
+- `freqs`: map from genre name to relative frequency. Genres that are not
+  listed get their default frequency.
+- `seed`: seed for the random number generator, so that rerunning the batch
+  gives the same playlists. Events without one get a seed drawn from the
+  master seed given by ``--seed``, which differs from every other event's.
+
+With ``--exclusive``, the songs are first split between the events, so that
+no song appears in more than one playlist.
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import generator
+import index
+import library
+import lf_site
+import playlist
+import siteconfig
+
+INDEX_NAME = 'leftfeet-index.sqlite'
+
+def load_events(path, genres_by_name, seed = 0):
+    '''
+    Read and check the events file.
+
+    :param int seed: master seed, from which the seeds of events that do not
+      give one are drawn
+
+    :return: list of dictionaries with keys `name`, `duration` (in seconds),
+      `freqs` (map from :py:class:`siteconfig.Genre` to frequency) and `seed`
+    :raise ValueError: if an event names an unknown genre
+    '''
+    with open(path) as f:
+        specs = json.load(f)
+    # Draw a default for every event, so that each depends only on its
+    # position, but skip any seed that another event already has
+    rng = random.Random(seed)
+    used = set(spec['seed'] for spec in specs if 'seed' in spec)
+    defaults = []
+    for spec in specs:
+        default = rng.getrandbits(32)
+        while default in used:
+            default = rng.getrandbits(32)
+        if 'seed' not in spec:
+            used.add(default)
+        defaults.append(default)
+    events = []
+    for i, spec in enumerate(specs):
+        freqs = {g: g.default_freq for g in genres_by_name.values()}
+        for name, freq in spec.get('freqs', {}).items():
+            if name not in genres_by_name:
+                raise ValueError('Unknown genre {!r} in event {}'.format(name, i))
+            freqs[genres_by_name[name]] = float(freq)
+        events.append({
+            'name': spec.get('name', 'event-{}'.format(i + 1)),
+            'duration': int(spec['duration'] * 60),
+            'freqs': freqs,
+            'seed': spec.get('seed', defaults[i])
+        })
+    return events
+
+def read_library(path, now):
+    '''
+    Read the candidate songs from the library index at `path`.
+
+    :return: tuple of the :py:class:`library.Snapshot` and the indices of
+      the candidates in it
+    '''
+    library_index = index.LibraryIndex(path)
+    if not library_index.synced:
+        print('{}: the plugin has not finished indexing the library, so songs may be missing'.format(path),
+              file = sys.stderr)
+    try:
+        snapshot = library.Snapshot()
+        candidates = library_index.load(snapshot, lf_site.classify, lf_site.valid_song, now)
+    finally:
+        library_index.close()
+    return snapshot, candidates
+
+def partition(snapshot, candidates, events, rng):
+    '''
+    Split the candidates between the events, so that no song is used twice.
+    Each event wants a share of its duration from each genre, according to
+    its frequencies. The songs are dealt out in random order, each to the
+    event that is furthest short of what it wants from one of the song's
+    genres.
+
+    :return: list of candidates for each event
+    '''
+    wanted = []
+    for event in events:
+        total = sum(event['freqs'].values())
+        wanted.append({g: event['duration'] * f / total for (g, f) in event['freqs'].items()})
+    order = list(candidates)
+    rng.shuffle(order)
+    parts = [[] for event in events]
+    for song in order:
+        genres = snapshot.genres(song)
+        best = None
+        best_need = None
+        for i, want in enumerate(wanted):
+            need = max(want.get(g, 0) for g in genres)
+            if best is None or need > best_need:
+                best = i
+                best_need = need
+        parts[best].append(song)
+        duration = snapshot.durations[song]
+        for g in genres:
+            if g in wanted[best]:
+                wanted[best][g] -= duration
+    for part in parts:
+        part.sort()
+    return parts
+
+# Inputs shared by all events, set in each worker process
+_shared = None
+
+def _init_worker(shared):
+    global _shared
+    _shared = shared
+
+def _run_event(task):
+    '''
+    Generate one playlist.
+
+    :param task: tuple of (frequencies as a list of `[genre index, freq]`,
+      duration, seed, candidates or `None` for all)
+    :return: tuple of (songs, names of the genres that ran out)
+    '''
+    freqs, duration, seed, candidates = task
+    snapshot, all_candidates, weights, genres, repel = _shared
+    if candidates is None:
+        candidates = all_candidates
+    rng = random.Random(seed)
+    weight = weights.__getitem__ if weights is not None else None
+    factory = library.Factory(snapshot, candidates, rng, weight)
+    gen = generator.Generator({genres[g]: f for (g, f) in freqs}, repel, factory, rng = rng)
+    gen.extend(duration)
+    return gen.commit(), [g.name for g in factory.missing]
+
+def generate_events(snapshot, candidates, events, exclusive = False, processes = None, weights = None):
+    '''
+    Generate a playlist for each event.
+
+    :param snapshot: the songs
+    :type snapshot: :py:class:`library.Snapshot`
+    :param list candidates: indices of the songs that may be chosen
+    :param list events: events, as returned by :py:func:`load_events`
+    :param bool exclusive: if true, no song is used for more than one event
+    :param int processes: number of worker processes (defaults to the number
+      of CPUs). With one process, the events are generated in this process.
+    :param list weights: if given, the weight of each song in the snapshot
+      (see :py:class:`library.Factory`)
+    :return: list of tuples of (songs, names of the genres that ran out), one
+      per event
+    '''
+    genres = list(lf_site.genres)
+    position = {g: i for (i, g) in enumerate(genres)}
+    if exclusive:
+        parts = partition(snapshot, candidates, events, random.Random(events[0]['seed'] if events else 0))
+    else:
+        parts = [None] * len(events)
+    tasks = [([[position[g], f] for (g, f) in event['freqs'].items()], event['duration'], event['seed'], part)
+             for (event, part) in zip(events, parts)]
+    shared = (snapshot, candidates, weights, genres, lf_site.repel)
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(tasks)))
+    if processes == 1:
+        _init_worker(shared)
+        try:
+            return [_run_event(task) for task in tasks]
+        finally:
+            _init_worker(None)
+    # The shared inputs are passed once per worker, rather than with each task
+    pool = multiprocessing.Pool(processes, _init_worker, (shared,))
+    try:
+        return pool.map(_run_event, tasks, chunksize = 1)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Generate playlists for a series of events')
+    parser.add_argument('events', help = 'JSON file describing the events')
+    parser.add_argument('--index', default = os.path.join(siteconfig.user_data_dir(), INDEX_NAME),
+                        help = 'library index kept by the plugin (default: %(default)s)')
+    parser.add_argument('--format', choices = playlist.FORMATS, default = 'm3u')
+    parser.add_argument('--exclusive', action = 'store_true',
+                        help = 'use each song in at most one playlist')
+    parser.add_argument('--processes', type = int, help = 'number of worker processes (default: one per CPU)')
+    parser.add_argument('--seed', type = int, default = 0,
+                        help = 'master seed for events that do not give their own (default: %(default)s)')
+    parser.add_argument('-o', '--output', default = '.', help = 'directory to write the playlists to')
+    args = parser.parse_args(argv)
+
+    events = load_events(args.events, lf_site.genres_by_name, args.seed)
+    now = time.time()
+    snapshot, candidates = read_library(args.index, now)
+    weights = None
+    if hasattr(lf_site, 'song_weight'):
+        weights = [lf_site.song_weight(snapshot.ratings[i], snapshot.play_counts[i],
+                                       snapshot.last_played[i], now)
+                   for i in range(len(snapshot))]
+    results = generate_events(snapshot, candidates, events, args.exclusive, args.processes, weights)
+    for event, (songs, missing) in zip(events, results):
+        path = os.path.join(args.output, '{}.{}'.format(event['name'], args.format))
+        tracks = [(snapshot.entries[song], snapshot.durations[song], None) for song in songs]
+        playlist.write(path, tracks, args.format, event['name'])
+        print('{}: {} songs'.format(path, len(songs)), file = sys.stderr)
+        if missing:
+            print('  ran out of: {}'.format(', '.join(sorted(set(missing)))), file = sys.stderr)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
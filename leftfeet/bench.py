@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+# LeftFeet: generates a Rhythmbox play queue for social dancing
+# Copyright (C) 2014  Bruce Merry <bmerry@users.sourceforge.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function
+
+'''
+Benchmarks for :py:func:`generator.generate_songs`, using synthetic
+libraries whose size and shape are set by each case rather than by a real
+music collection.
+
+Each case is described by the number of songs to generate, the number of
+genres, the fraction of songs that have two genres, the window size and the
+number of songs in the prefix, and whether the repulsion is given as a
+:py:class:`generator.RepulsionModel` or as a dictionary. By default, each parameter is swept in turn
+while the others keep their default values. For each case, the wall time,
+99th percentile of the time per song, peak memory, number of repulsion
+lookups, the final :py:func:`generator.score` and the error in the genre
+counts are reported. Each case is run with every backend, and with each
+strategy given by ``--strategy`` (by default only ``insert``). With
+``--search``, insertion only considers some of the positions (see
+:py:class:`generator.SlotSearch`), and the energy given up at each audited
+song is also reported, so that the score and latency can be compared with a
+run without it. The results are written as JSON, and may be compared against a previous run with ``--baseline``.
+'''
+
+import argparse
+import json
+import random
+import sys
+import time
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None   # Python 2
+
+import generator
+import library
+import lf_site
+
+DEFAULTS = {
+    'songs': 1000,
+    'genres': 12,
+    'multi': 0.2,
+    'window': 10,
+    'prefix': 0,
+    'model': False
+}
+
+SWEEPS = {
+    'songs': [100, 1000, 5000, 20000],
+    'genres': [12, 50, 200, 500],
+    'multi': [0.0, 0.2, 0.5],
+    'window': [5, 10, 20, 40],
+    'prefix': [0, 100, 1000],
+    'model': [False, True]
+}
+
+def make_genres(count, rs):
+    '''
+    Create synthetic genres with random levels, groups and energies.
+    '''
+    return [lf_site.Genre('genre{}'.format(i),
+                          rs.choice([lf_site.OPEN, lf_site.BEGINNER, lf_site.INTERMEDIATE, lf_site.ADVANCED]),
+                          rs.choice([lf_site.BALLROOM, lf_site.LATIN, lf_site.OTHER]),
+                          rs.choice([0, 0, 1]))
+            for i in range(count)]
+
+def make_repel(genres):
+    '''
+    Build a repulsion table using the same rules as the stock
+    :py:mod:`lf_site`.
+    '''
+    repel = {}
+    for i in genres:
+        for j in genres:
+            rep = 20 if i is j else 0
+            rep += i.energy * j.energy
+            rep += 5 - abs(i.level - j.level)
+            if i.group == j.group:
+                rep += 1
+            repel[(i, j)] = rep
+    return repel
+
+def make_model(genres):
+    '''
+    Build a :py:class:`generator.RepulsionModel` equivalent to
+    :py:func:`make_repel`.
+    '''
+    levels = [lf_site.OPEN, lf_site.BEGINNER, lf_site.INTERMEDIATE, lf_site.ADVANCED]
+    return generator.RepulsionModel([
+        generator.Same(lambda g: g.name, 20),
+        generator.Product(lambda g: g.energy),
+        generator.Lookup(lambda g: g.level,
+                         {(a, b): 5 - abs(a - b) for a in levels for b in levels}),
+        generator.Same(lambda g: g.group, 1)
+    ])
+
+def make_case(params, seed):
+    '''
+    Build the inputs for one case. Every song has duration 1, so the
+    duration passed to the generator is the number of songs to generate. The
+    library has three times as many songs as needed, spread over the genres
+    in proportion to their frequencies.
+
+    :return: tuple of (freqs, repel, factory, prefix)
+    '''
+    rs = random.Random(seed)
+    genres = make_genres(params['genres'], rs)
+    freqs = {g: rs.uniform(0.1, 1.0) for g in genres}
+    weights = [freqs[g] for g in genres]
+    snapshot = library.Snapshot()
+
+    def random_genres():
+        first = _weighted_choice(genres, weights, rs)
+        if rs.random() < params['multi']:
+            second = rs.choice(genres)
+            if second is not first:
+                return [first, second]
+        return [first]
+
+    prefix = [snapshot.add(None, 1, 5, 0, 320, True, random_genres())
+              for i in range(params['prefix'])]
+    candidates = [snapshot.add(None, 1, 5, 0, 320, True, random_genres())
+                  for i in range(3 * params['songs'])]
+    factory = library.Factory(snapshot, candidates)
+    repel = make_model(genres) if params['model'] else make_repel(genres)
+    return freqs, repel, factory, prefix
+
+def _weighted_choice(items, weights, rs):
+    x = rs.uniform(0.0, sum(weights))
+    for item, weight in zip(items, weights):
+        x -= weight
+        if x < 0:
+            return item
+    return items[-1]
+
+def run_case(params, seed, backend, memory, strategy = 'insert', search = None):
+    '''
+    Run one case and return a dictionary of results.
+
+    :param dict search: if given, keyword arguments for a
+      :py:class:`generator.SlotSearch` to limit the insertion search
+    '''
+    generator.set_window(params['window'])
+    freqs, repel, factory, prefix = make_case(params, seed)
+    random.seed(seed)
+    stats = generator.Stats()
+    slots = generator.SlotSearch(**search) if search else None
+    start = time.time()
+    gen = generator.strategies[strategy](freqs, repel, factory, prefix, backend, stats,
+                                         search = slots)
+    gen.extend(params['songs'])
+    elapsed = time.time() - start
+
+    peak = None
+    if memory and tracemalloc is not None:
+        # Repeat with tracing enabled, since it slows things down
+        case = make_case(params, seed)
+        random.seed(seed)
+        tracemalloc.start()
+        try:
+            generator.generate_songs(case[0], case[1], params['songs'], case[2], case[3], backend,
+                                     strategy = strategy,
+                                     search = generator.SlotSearch(**search) if search else None)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    sets = generator.GenreSets(repel)
+    sequence = [sets.intern(factory.get_genres(song)) for song in prefix + gen.songs]
+    total = sum(gen.seen.values())
+    tfreq = sum(freqs.values())
+    errors = [abs(gen.seen[g] - total * freqs[g] / tfreq) for g in freqs]
+    return {
+        'params': params,
+        'backend': backend,
+        'strategy': strategy,
+        'search': search,
+        'time': elapsed,
+        'latency_p99': stats.percentile(99),
+        'peak_memory': peak,
+        'lookups': stats.lookups,
+        'score': generator.score(sequence, sets.table),
+        'freq_error_max': max(errors),
+        'freq_error_mean': sum(errors) / len(errors),
+        'missing': len(factory.missing),
+        # Energy given up per audited song, relative to the full search
+        'regret': slots.regret / slots.audited if slots is not None and slots.audited else None
+    }
+
+def case_name(params):
+    return ','.join('{}={}'.format(key, params[key]) for key in sorted(params))
+
+def result_name(result):
+    # Results from before strategies were added used insertion. The search
+    # is left out, so that a limited search can be compared with a full one.
+    return '{}/{}/{}'.format(case_name(result['params']), result.get('strategy', 'insert'),
+                             result['backend'])
+
+def make_cases(sweep, max_songs, model):
+    '''
+    Generate the parameters for each case, sweeping one parameter at a time.
+    '''
+    defaults = dict(DEFAULTS, model = model)
+    seen = set()
+    for key in sorted(SWEEPS):
+        if sweep and key not in sweep:
+            continue
+        for value in SWEEPS[key]:
+            params = dict(defaults)
+            params[key] = value
+            name = case_name(params)
+            if params['songs'] <= max_songs and name not in seen:
+                seen.add(name)
+                yield params
+
+def compare(results, baseline):
+    '''
+    Print the change in each metric relative to a baseline run.
+    '''
+    old = {result_name(r): r for r in baseline['results']}
+    for r in results:
+        name = result_name(r)
+        if name not in old:
+            continue
+        base = old[name]
+        parts = []
+        for key in ['time', 'latency_p99', 'peak_memory', 'lookups', 'score', 'freq_error_max']:
+            if r[key] is not None and base.get(key):
+                parts.append('{} {:+.1%}'.format(key, r[key] / base[key] - 1))
+        print('{}: {}'.format(name, ', '.join(parts)))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Benchmark the play queue generator')
+    parser.add_argument('--sweep', action = 'append', choices = sorted(SWEEPS),
+                        help = 'parameter to sweep (may be repeated; default all)')
+    parser.add_argument('--max-songs', type = int, default = 20000,
+                        help = 'skip cases that generate more songs than this')
+    parser.add_argument('--backend', action = 'append', choices = sorted(generator.backends),
+                        help = 'backend to benchmark (may be repeated; default all)')
+    parser.add_argument('--strategy', action = 'append', choices = sorted(generator.strategies),
+                        help = 'strategy to benchmark (may be repeated; default insert)')
+    parser.add_argument('--search', choices = generator.SlotSearch.MODES,
+                        help = 'limit the positions considered by insertion (see SlotSearch)')
+    parser.add_argument('--search-count', type = int, default = 64,
+                        help = 'number of positions considered with --search')
+    parser.add_argument('--search-time', type = float,
+                        help = 'time budget per song for --search, in seconds')
+    parser.add_argument('--model', action = 'store_true',
+                        help = 'use a repulsion model in every case, not just the model sweep')
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--no-memory', dest = 'memory', action = 'store_false',
+                        help = 'skip the peak memory measurement')
+    parser.add_argument('-o', '--output', help = 'file to write JSON results to (default stdout)')
+    parser.add_argument('--baseline', help = 'JSON results from an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    backends = args.backend or sorted(generator.backends)
+    strategies = args.strategy or ['insert']
+    search = None
+    if args.search:
+        search = {'mode': args.search, 'count': args.search_count, 'per_song': args.search_time}
+    results = []
+    for params in make_cases(args.sweep, args.max_songs, args.model):
+        for strategy in strategies:
+            # The backend only affects insertion
+            for backend in (backends if strategy == 'insert' else backends[:1]):
+                result = run_case(params, args.seed, backend, args.memory, strategy,
+                                  search if strategy == 'insert' else None)
+                print('{}: {:.3f}s'.format(result_name(result), result['time']), file = sys.stderr)
+                results.append(result)
+    report = {'python': sys.version.split()[0], 'numpy': generator.np is not None, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2, sort_keys = True)
+    else:
+        json.dump(report, sys.stdout, indent = 2, sort_keys = True)
+        print()
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,213 @@
+# LeftFeet: generates a Rhythmbox play queue for social dancing
+# Copyright (C) 2014  Bruce Merry <bmerry@users.sourceforge.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import division, print_function
+
+'''
+Generates a playlist straight from Rhythmbox's database file, on a machine
+where Rhythmbox (or even the GObject bindings) is not installed.
+
+The database file is read in blocks with an incremental (expat) parser that
+keeps only the properties LeftFeet uses, and each entry is discarded as soon
+as it has been examined, so memory use depends on the number of candidate
+songs rather than on the size of the file. No element tree is built, which
+also makes it faster than :py:func:`xml.etree.ElementTree.iterparse`. Songs are
+filtered with :py:func:`lf_site.valid_song`, classified with
+:py:func:`lf_site.classify` and weighted with :py:func:`lf_site.song_weight`,
+just as the plugin does.
+'''
+
+import argparse
+import os
+import random
+import sys
+import time
+import xml.parsers.expat
+
+import generator
+import library
+import lf_site
+import playlist
+import replay
+import siteconfig
+
+DB_NAME = 'rhythmdb.xml'
+
+# Media types that Rhythmbox considers lossless
+LOSSLESS_TYPES = frozenset(['audio/x-alac', 'audio/x-flac', 'audio/x-shorten', 'audio/x-wavpack'])
+
+# Properties of an entry that are read; others are skipped
+FIELDS = frozenset(['location', 'genre', 'duration', 'rating', 'last-played', 'bitrate',
+                    'media-type', 'play-count', 'title', 'hidden'])
+# Size of the blocks read from the database file
+BLOCK_SIZE = 65536
+
+class _EntryHandler(object):
+    '''
+    Callbacks for the expat parser, which collect the entries of one type.
+    '''
+    def __init__(self, entry_type):
+        self.entry_type = entry_type
+        self.entries = []
+        self._entry = None
+        self._field = None
+
+    def start(self, tag, attrs):
+        if tag == 'entry':
+            self._entry = {} if attrs.get('type') == self.entry_type else None
+        elif tag in FIELDS and self._entry is not None:
+            self._field = tag
+
+    def end(self, tag):
+        if tag == 'entry' and self._entry is not None:
+            self.entries.append(self._entry)
+            self._entry = None
+        self._field = None
+
+    def data(self, text):
+        if self._field is not None:
+            # Text may arrive in pieces, at the end of a block for example
+            entry = self._entry
+            entry[self._field] = entry.get(self._field, '') + text
+
+def iter_entries(source, entry_type = 'song'):
+    '''
+    Yield the entries of a Rhythmbox database file, each as a dictionary
+    mapping the names of its properties in :py:data:`FIELDS` (such as
+    `location` or `play-count`) to their text. Entries that are not of
+    `entry_type` are skipped.
+
+    :param str source: file name
+    '''
+    handler = _EntryHandler(entry_type)
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+    parser.CharacterDataHandler = handler.data
+    entries = handler.entries
+    with open(source, 'rb') as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            parser.Parse(block, not block)
+            for entry in entries:
+                yield entry
+            del entries[:]
+            if not block:
+                break
+
+def entry_properties(entry):
+    '''
+    Convert an entry from :py:func:`iter_entries` to its properties, in the
+    order given by :py:data:`index.COLUMNS`.
+    '''
+    get = entry.get
+    return (get('location'),
+            get('genre') or '',
+            int(get('duration') or 0),
+            float(get('rating') or 0),
+            int(get('last-played') or 0),
+            int(get('bitrate') or 0),
+            get('media-type') in LOSSLESS_TYPES,
+            int(get('play-count') or 0))
+
+def read_library(source, now):
+    '''
+    Read the candidate songs from a Rhythmbox database file.
+
+    :return: tuple of the :py:class:`library.Snapshot` of the candidates, and
+      a list of their titles
+    '''
+    snapshot = library.Snapshot()
+    titles = []
+    for entry in iter_entries(source):
+        if entry.get('hidden') == '1':
+            continue
+        location, genre, duration, rating, last_played, bitrate, lossless, play_count = \
+            entry_properties(entry)
+        genres = lf_site.classify(genre)
+        if genres and lf_site.valid_song(rating, last_played, bitrate, lossless, now):
+            snapshot.add(location, duration, rating, last_played, bitrate, lossless, genres, play_count)
+            titles.append(entry.get('title'))
+    return snapshot, titles
+
+def parse_freqs(specs):
+    '''
+    Build the frequencies from `name=value` strings, starting from the
+    default frequency of each genre.
+
+    :raise ValueError: if a string is malformed or names an unknown genre
+    '''
+    freqs = {g: g.default_freq for g in lf_site.genres}
+    for spec in specs:
+        name, sep, value = spec.rpartition('=')
+        if not sep or name not in lf_site.genres_by_name:
+            raise ValueError('Expected GENRE=FREQ with a known genre, not {!r}'.format(spec))
+        freqs[lf_site.genres_by_name[name]] = float(value)
+    return freqs
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Generate a playlist from the Rhythmbox database')
+    parser.add_argument('output', help = 'playlist file to write (.m3u or .xspf)')
+    parser.add_argument('--db', default = os.path.join(siteconfig.user_data_dir(), DB_NAME),
+                        help = 'Rhythmbox database file (default: %(default)s)')
+    parser.add_argument('--duration', type = float, default = 240, help = 'length in minutes')
+    parser.add_argument('--freq', action = 'append', default = [], metavar = 'GENRE=FREQ',
+                        help = 'relative frequency of a genre (may be repeated)')
+    parser.add_argument('--format', choices = playlist.FORMATS,
+                        help = 'playlist format (default: from the file name)')
+    parser.add_argument('--seed', type = int, help = 'seed for the random number generator')
+    parser.add_argument('--trace', metavar = 'FILE',
+                        help = 'record the decisions made, to be checked with replay.py')
+    args = parser.parse_args(argv)
+
+    try:
+        freqs = parse_freqs(args.freq)
+    except ValueError as e:
+        parser.error(str(e))
+    now = time.time()
+    snapshot, titles = read_library(args.db, now)
+    rng = random.Random(args.seed)
+
+    def weight(i):
+        return lf_site.song_weight(snapshot.ratings[i], snapshot.play_counts[i],
+                                   snapshot.last_played[i], now)
+
+    factory = library.Factory(snapshot, None, rng, weight if hasattr(lf_site, 'song_weight') else None)
+    duration = int(args.duration * 60)
+    recorder = None
+    gen_rng = rng
+    if args.trace:
+        # The generator needs random numbers of its own to be replayed
+        recorder = replay.TraceRecorder(open(args.trace, 'w'), lf_site.genres, lf_site.repel,
+                                        freqs, factory, seed = rng.getrandbits(32),
+                                        duration = duration)
+        gen_rng = recorder.rng
+    gen = generator.Generator(freqs, lf_site.repel, factory, rng = gen_rng, trace = recorder)
+    gen.extend(duration)
+    songs = gen.commit()
+    if recorder is not None:
+        recorder.close()
+    tracks = [(snapshot.entries[i], snapshot.durations[i], titles[i]) for i in songs]
+    playlist.write(args.output, tracks, args.format)
+    print('{}: {} songs from {} candidates'.format(args.output, len(songs), len(snapshot)), file = sys.stderr)
+    if factory.missing:
+        print('ran out of: {}'.format(', '.join(sorted(set(g.name for g in factory.missing)))),
+              file = sys.stderr)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
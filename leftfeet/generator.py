@@ -37,30 +37,59 @@ that songs of the same (or very similar) genres repel each other, causing them
 to be evenly spread out rather than clumped together.
 
 To generate the list, songs are generated one at a time and inserted. The next
-song is the one that is further behind the expected number of plays based on
-its desired frequency. The frequency goals are thus met exactly (to the extent
-possibly with rounding) rather than arising stochastically. The new song is
-then inserted into the position that minimises the energy of the resulting
-list. When selecting a genre or a position, ties are broken randomly,
-which gives the list some random variation.
+song is from a genre that is behind its desired frequency: of those, the one
+whose next song is due soonest is chosen (see :py:class:`GenreQueue`). The
+frequency goals are thus met exactly (to the extent possibly with rounding)
+rather than arising stochastically. The new song is then inserted into the
+position that minimises the energy of the resulting list. When selecting a
+genre or a position, ties are broken randomly, which gives the list some
+random variation.
 
 Songs may also be classified as having multiple genres. When picking the next
 song, a single genre is chosen, and this single genre is used in evaluating
 frequency targets. However, the scoring function takes the maximum energy over
 all pairings.
+
+There are two implementations of the search for the best position. The
+default uses NumPy to score every position at once, and falls back to a pure
+Python implementation if NumPy is not installed. Both make the same choices
+given the same state of the random number generator.
 '''
 
+import array
+import collections
+import heapq
+import importlib
+import math
+import os
 import random
+import sys
+import time
+import multiprocessing
+from contextlib import contextmanager
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+try:
+    from . import library
+except (ImportError, ValueError):
+    import library
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 WINDOW = 10
 # Scaling weights: inverses, but integral to avoid floating-point issues
 weights = [0] + [2520 // i for i in range(1, WINDOW + 1)]
 
-def pick_smallest(kv):
+def pick_smallest(kv, rng = random):
     '''
     In a list of key, value pairs, finds the one with the smallest value and
-    returns the key. Ties are broken uniformly at random. If `kv` is empty,
-    returns `None`.
+    returns the key. Ties are broken uniformly at random, using `rng` (which
+    defaults to the :py:mod:`random` module). If `kv` is empty, returns
+    `None`.
     '''
     nbest = 0
     best_key = None
@@ -71,7 +100,7 @@ def pick_smallest(kv):
             best_value = value
             nbest = 1
         elif value == best_value:
-            if random.randint(0, nbest) == 0:
+            if rng.randint(0, nbest) == 0:
                 best_key = key
             nbest += 1
     return best_key
@@ -89,48 +118,1640 @@ def repulsion(songs1, songs2, repel):
             ans = max(ans, repel[(g1, g2)])
     return ans
 
-def score_single(sequence, repel, pos):
+class Same(object):
+    '''
+    Repulsion term worth `weight` when two genres have the same value of a
+    feature.
+
+    :ivar key: function mapping a genre to its feature value
+    :ivar weight: repulsion when the values match
+    '''
+    def __init__(self, key, weight):
+        self.key = key
+        self.weight = weight
+
+    def __call__(self, a, b):
+        return self.weight if self.key(a) == self.key(b) else 0
+
+class Product(object):
+    '''
+    Repulsion term equal to `weight` times the product of a numeric feature
+    of the two genres.
+
+    :ivar key: function mapping a genre to its feature value
+    :ivar weight: scale factor
+    '''
+    def __init__(self, key, weight = 1):
+        self.key = key
+        self.weight = weight
+
+    def __call__(self, a, b):
+        return self.weight * self.key(a) * self.key(b)
+
+class Lookup(object):
+    '''
+    Repulsion term given by a small table indexed by a categorical feature of
+    each genre, such as its level.
+
+    :ivar key: function mapping a genre to its feature value
+    :ivar dict values: repulsion for each pair of feature values (all pairs
+      must be present)
+    '''
+    def __init__(self, key, values):
+        self.key = key
+        self.values = values
+
+    def __call__(self, a, b):
+        return self.values[(self.key(a), self.key(b))]
+
+class RepulsionModel(object):
+    '''
+    Repulsion between genres expressed as a sum of terms, each depending on
+    one feature of the genres (see :py:class:`Same`, :py:class:`Product` and
+    :py:class:`Lookup`). It may be used anywhere a dictionary of repulsion
+    forces is accepted, and only needs to be given the features rather
+    than every pair of genres. Values are computed when first looked up,
+    and remembered.
+
+    :ivar list terms: the terms
+    '''
+    def __init__(self, terms):
+        self.terms = list(terms)
+        self._cache = {}
+
+    def __getitem__(self, pair):
+        ans = self._cache.get(pair)
+        if ans is None:
+            a, b = pair
+            ans = sum(term(a, b) for term in self.terms)
+            self._cache[pair] = ans
+        return ans
+
+class GenreSets(object):
+    '''
+    Interns each distinct list of genres to a small integer ID, and keeps a
+    dense table of the repulsion between every pair of IDs. The generator
+    works entirely in terms of these IDs, so that looking up a repulsion is
+    just two list indexing operations.
+
+    :ivar list sets: tuple of genres for each ID
+    :ivar dict ids: maps each tuple of genres to its ID
+    :ivar list table: `table[a][b]` is the repulsion between IDs `a` and `b`
+    '''
+    def __init__(self, repel, genres = ()):
+        self.repel = repel
+        self.sets = []
+        self.ids = {}
+        self.table = []
+        for g in genres:
+            self.intern([g])
+
+    def intern(self, genres):
+        '''
+        Return the ID for a list of genres, allocating a new one if necessary.
+        '''
+        key = tuple(genres)
+        ans = self.ids.get(key)
+        if ans is None:
+            ans = len(self.sets)
+            self.sets.append(key)
+            self.ids[key] = ans
+            for other, row in zip(self.sets, self.table):
+                row.append(repulsion(other, key, self.repel))
+            self.table.append([repulsion(key, other, self.repel) for other in self.sets])
+        return ans
+
+def score_single(sequence, table, pos):
     '''
     Computes the portion of the heuristic due to a single item.
 
-    :param list sequence: list of genres for each song in list
-    :param dict repel: table of repulsion forces
+    :param list sequence: list of genre set IDs for each song in list
+    :param list table: table of repulsion forces between genre set IDs
     :param int pos: position of item to evaluate
     '''
     ans = 0
+    row = table[sequence[pos]]
     for i in range(max(0, pos - WINDOW), pos):
-        ans += repulsion(sequence[i], sequence[pos], repel) * weights[pos - i]
+        ans += table[sequence[i]][sequence[pos]] * weights[pos - i]
     for i in range(pos + 1, min(pos + WINDOW + 1, len(sequence))):
-        ans += repulsion(sequence[pos], sequence[i], repel) * weights[i - pos]
+        ans += row[sequence[i]] * weights[i - pos]
     return ans
 
-def score_pair(sequence, repel, pos):
+def score_pair(sequence, table, pos):
     '''
     Computes the portion of the heuristic due to two adjacent elements.
     '''
-    ans = -(repulsion(sequence[pos], sequence[pos + 1], repel) * weights[1]) # Inclusion-exclusion
-    ans += score_single(sequence, repel, pos)
-    ans += score_single(sequence, repel, pos + 1)
+    ans = -(table[sequence[pos]][sequence[pos + 1]] * weights[1]) # Inclusion-exclusion
+    ans += score_single(sequence, table, pos)
+    ans += score_single(sequence, table, pos + 1)
+    return ans
+
+def score_positions(sequence, table, positions):
+    '''
+    Computes the portion of the heuristic due to pairs that involve at least
+    one of the given positions.
+
+    :param list positions: sorted, distinct positions in `sequence`
+    '''
+    ans = 0
+    for p in positions:
+        ans += score_single(sequence, table, p)
+    # Pairs with both ends in positions were counted twice
+    for a, p in enumerate(positions):
+        for q in positions[a + 1:]:
+            if q - p > WINDOW:
+                break
+            ans -= table[sequence[p]][sequence[q]] * weights[q - p]
     return ans
 
-def score(sequence, repel):
+def score(sequence, table):
     '''
     Computes score for the entire sequence. It is not used, but is retained
     for debugging purposes.
+
+    :param list sequence: list of genre set IDs for each song in list
+    :param list table: table of repulsion forces between genre set IDs
     '''
     ans = 0
     for i in range(1, len(sequence)):
         for j in range(max(0, i - WINDOW), i):
-            ans += repulsion(sequence[j], sequence[i], repel) * weights[i - j]
+            ans += table[sequence[j]][sequence[i]] * weights[i - j]
+    return ans
+
+def refine_sequence(sequence, table, start, budget, songs = None, max_moves = None, rng = random):
+    '''
+    Improve a sequence by simulated annealing, after the insertion heuristic
+    has finished with it. Each move either swaps two songs or reverses a run
+    of up to WINDOW songs, and is scored using only the pairs it affects (see
+    :py:func:`score_positions`), so it costs O(WINDOW) (or O(WINDOW**2) for a
+    reversal) rather than a full :py:func:`score`. The temperature falls from
+    one unit of the strongest adjacent repulsion to near zero over the time
+    budget.
+
+    Only positions from `start` onwards are moved, and since every move is a
+    permutation, the genre counts are unchanged.
+
+    :param list sequence: genre set IDs, modified in place
+    :param list table: table of repulsion forces between genre set IDs
+    :param int start: number of leading positions that must not move
+    :param budget: time limit in seconds
+    :param list songs: if given, `songs[k]` is moved along with
+      `sequence[start + k]`
+    :param int max_moves: if given, stop after this many moves
+    :param rng: source of random numbers
+    :return: the change in :py:func:`score` (zero or negative)
+    '''
+    n = len(sequence)
+    if n - start < 2:
+        return 0
+    deadline = time.time() + budget
+    t0 = max(max(row) for row in table) * weights[1] or 1
+    total = 0
+    best = 0
+    best_sequence = sequence[start:]
+    best_songs = list(songs) if songs is not None else None
+    moves = 0
+    temperature = t0
+    while max_moves is None or moves < max_moves:
+        if moves % 64 == 0:
+            now = time.time()
+            if now >= deadline:
+                break
+            # Geometric cooling from t0 to t0 / 10000 over the budget
+            temperature = t0 * 1e-4 ** (1.0 - (deadline - now) / budget)
+        moves += 1
+        i = rng.randrange(start, n)
+        if rng.random() < 0.5:
+            j = rng.randrange(start, n)
+            if i == j:
+                continue
+            positions = sorted((i, j))
+        else:
+            j = min(n, i + rng.randint(2, WINDOW))
+            positions = list(range(i, j))
+            if len(positions) < 2:
+                continue
+        before = score_positions(sequence, table, positions)
+        _apply_move(sequence, songs, start, positions)
+        delta = score_positions(sequence, table, positions) - before
+        if delta <= 0 or rng.random() < math.exp(-delta / temperature):
+            total += delta
+            if total < best:
+                best = total
+                best_sequence = sequence[start:]
+                best_songs = list(songs) if songs is not None else None
+        else:
+            _apply_move(sequence, songs, start, positions)   # Both moves are self-inverse
+    sequence[start:] = best_sequence
+    if songs is not None:
+        songs[:] = best_songs
+    return best
+
+def _apply_move(sequence, songs, start, positions):
+    '''
+    Swap two songs (if `positions` are not contiguous) or reverse a run.
+    '''
+    lo = positions[0]
+    hi = positions[-1]
+    if len(positions) == 2:
+        sequence[lo], sequence[hi] = sequence[hi], sequence[lo]
+        if songs is not None:
+            songs[lo - start], songs[hi - start] = songs[hi - start], songs[lo - start]
+    else:
+        sequence[lo:hi + 1] = sequence[lo:hi + 1][::-1]
+        if songs is not None:
+            songs[lo - start:hi - start + 1] = songs[lo - start:hi - start + 1][::-1]
+
+class GenreQueue(object):
+    '''
+    Chooses the genre to generate next. After `N` songs, a genre with
+    normalized frequency `f` that has been generated `n` times is behind
+    its share if `n <= N * f`. Among the genres that are behind, the one
+    whose next song is due soonest, at position `(n + 1) / f`, is chosen.
+    This keeps every count within one song of its share, as the old rule of
+    choosing the largest deficit did, but each choice costs O(log G) for G
+    genres.
+
+    The genres are kept in two heaps. Genres that are ahead of their share
+    wait in a release heap keyed by `n / f`, the position at which they
+    fall behind, and move to a ready heap keyed by `(n + 1) / f` once the
+    list reaches it. Keys only change when their own genre is chosen. If no
+    genre is behind (which can happen once a genre has been exhausted), the
+    one that is due to be released first is released early.
+
+    Ties are broken uniformly at random: each heap entry carries a random
+    number that decides between entries with the same key. A genre with zero
+    frequency is never released on time, so it is only chosen once all
+    other genres are exhausted.
+
+    :ivar dict freqs: normalized frequency of each genre not yet exhausted
+    :ivar dict seen: number of times each genre has been chosen
+    :ivar rng: source of random numbers for breaking ties
+    '''
+    # Slack when comparing positions, which are computed in floating point
+    epsilon = 1e-9
+
+    def __init__(self, freqs, seen = None, rng = random):
+        self.freqs = freqs
+        self.seen = seen if seen is not None else {g: 0 for g in freqs}
+        self.rng = rng
+        self._order = {g: i for (i, g) in enumerate(freqs)}  # Avoids comparing genres
+        self._count = sum(self.seen.values())
+        self._ready = []
+        self._release = [(self._position(g, 0), self.rng.random(), self._order[g], g) for g in freqs]
+        heapq.heapify(self._release)
+        self._fill()
+
+    def _position(self, genre, extra):
+        freq = self.freqs[genre]
+        return (self.seen.get(genre, 0) + extra) / freq if freq > 0 else float('inf')
+
+    def _fill(self):
+        '''
+        Move the genres that have fallen behind to the ready heap.
+        '''
+        release = self._release
+        while release and release[0][0] <= self._count + self.epsilon:
+            _, r, order, g = heapq.heappop(release)
+            heapq.heappush(self._ready, (self._position(g, 1), r, order, g))
+        if not self._ready and release:
+            _, r, order, g = heapq.heappop(release)
+            self._ready.append((self._position(g, 1), r, order, g))
+
+    def get_state(self, index):
+        '''
+        Return the ready and release heaps, as lists of `[key, tie-break,
+        order, genre]` lists, with each genre replaced by `index[genre]`.
+        '''
+        return {
+            'ready': [[key, r, order, index[g]] for (key, r, order, g) in self._ready],
+            'release': [[key, r, order, index[g]] for (key, r, order, g) in self._release]
+        }
+
+    @classmethod
+    def restore(cls, freqs, seen, state, genres, rng = random):
+        '''
+        Recreate a queue from the state returned by :py:meth:`get_state`,
+        without drawing any random numbers.
+
+        :param list genres: genres, indexed as in `state`
+        '''
+        self = cls.__new__(cls)
+        self.freqs = freqs
+        self.seen = seen
+        self.rng = rng
+        self._count = sum(seen.values())
+        self._ready = [(key, r, order, genres[g]) for (key, r, order, g) in state['ready']]
+        self._release = [(key, r, order, genres[g]) for (key, r, order, g) in state['release']]
+        self._order = {entry[3]: entry[2] for entry in self._ready + self._release}
+        heapq.heapify(self._ready)
+        heapq.heapify(self._release)
+        return self
+
+    def __len__(self):
+        return len(self._ready) + len(self._release)
+
+    def peek(self):
+        '''
+        Return the genre to generate next.
+        '''
+        return self._ready[0][3]
+
+    def advance(self):
+        '''
+        Record that a song was generated for the genre returned by
+        :py:meth:`peek`.
+        '''
+        genre = heapq.heappop(self._ready)[3]
+        self.seen[genre] = self.seen.get(genre, 0) + 1
+        self._count += 1
+        heapq.heappush(self._release, (self._position(genre, 0), self.rng.random(),
+                                       self._order[genre], genre))
+        self._fill()
+
+    def remove(self):
+        '''
+        Drop the genre returned by :py:meth:`peek`, because it is exhausted.
+        '''
+        genre = heapq.heappop(self._ready)[3]
+        del self.freqs[genre]
+        self._fill()
+
+# Change in weight when a pair of songs is pushed one step further apart
+weight_deltas = [weights[i + 1] - weights[i] for i in range(WINDOW)] + [-weights[WINDOW]]
+
+def set_window(window):
+    '''
+    Change :py:data:`WINDOW` and recompute the weights to match. This affects
+    all later generation, and is intended for experiments and benchmarks.
+    '''
+    global WINDOW, weights, weight_deltas
+    # Least common multiple of 1..window, to keep the weights integral
+    scale = 1
+    for i in range(2, window + 1):
+        a, b = scale, i
+        while b:
+            a, b = b, a % b
+        scale = scale * i // a
+    WINDOW = window
+    weights = [0] + [scale // i for i in range(1, window + 1)]
+    weight_deltas = [weights[i + 1] - weights[i] for i in range(window)] + [-weights[window]]
+
+class BlockedList(object):
+    '''
+    A list of genre set IDs, each optionally paired with a song, stored as a
+    list of chunks of about sqrt(N) elements. Inserting into the middle only
+    moves the elements of one chunk, plus the list of chunks, so it costs
+    O(sqrt(N)) rather than O(N). The IDs of each chunk are kept in a compact
+    :py:class:`array.array`, next to a plain list of the songs.
+
+    Elements are read a range at a time with :py:meth:`ids` and
+    :py:meth:`songs`, which is the way the scoring code uses them.
+
+    :param ids: initial genre set IDs
+    :param songs: initial songs, one per ID. If not given, the list has no
+      songs, and the `song` arguments to :py:meth:`insert` are ignored.
+    '''
+    MIN_CHUNK = 64
+
+    def __init__(self, ids = (), songs = None):
+        self._has_songs = songs is not None
+        self._rebuild(list(ids), list(songs) if songs is not None else None)
+
+    def _rebuild(self, ids, songs):
+        '''
+        Split the elements into chunks, sized for the current length.
+        '''
+        n = len(ids)
+        size = max(self.MIN_CHUNK, int(math.sqrt(n)))
+        self._size = size
+        self._len = n
+        self._ids = [array.array('i', ids[i:i + size]) for i in range(0, n, size)]
+        if songs is not None:
+            self._songs = [songs[i:i + size] for i in range(0, n, size)]
+        else:
+            self._songs = None
+
+    def __len__(self):
+        return self._len
+
+    def _locate(self, pos):
+        '''
+        Return the index of the chunk holding element `pos`, and the offset
+        of `pos` within it. A position at the end of a chunk is placed in
+        that chunk rather than at the start of the next.
+        '''
+        for c, chunk in enumerate(self._ids):
+            if pos <= len(chunk):
+                return c, pos
+            pos -= len(chunk)
+        raise IndexError('position out of range')
+
+    def insert(self, pos, key, song = None):
+        '''
+        Insert an element before element `pos`.
+        '''
+        if not 0 <= pos <= self._len:
+            raise IndexError('position out of range')
+        if not self._ids:
+            self._ids.append(array.array('i'))
+            if self._has_songs:
+                self._songs.append([])
+        c, offset = self._locate(pos)
+        chunk = self._ids[c]
+        chunk.insert(offset, key)
+        if self._has_songs:
+            self._songs[c].insert(offset, song)
+        self._len += 1
+        if len(chunk) > 2 * self._size:
+            if self._size ** 2 < self._len // 4:
+                # Chunks have become too small for the length
+                self._rebuild(self.ids(), self.songs() if self._has_songs else None)
+            else:
+                half = len(chunk) // 2
+                self._ids[c + 1:c + 1] = [chunk[half:]]
+                del chunk[half:]
+                if self._has_songs:
+                    songs = self._songs[c]
+                    self._songs[c + 1:c + 1] = [songs[half:]]
+                    del songs[half:]
+
+    def append(self, key, song = None):
+        self.insert(self._len, key, song)
+
+    def _slices(self, chunks, start, end):
+        '''
+        Concatenate elements [`start`, `end`) of the chunks in `chunks`.
+        '''
+        ans = []
+        for chunk in chunks:
+            n = len(chunk)
+            if start < n and end > 0:
+                ans.extend(chunk[max(start, 0):min(end, n)])
+            start -= n
+            end -= n
+            if end <= 0:
+                break
+        return ans
+
+    def ids(self, start = 0, end = None):
+        '''
+        Return the genre set IDs of elements [`start`, `end`) as a list.
+        '''
+        if end is None:
+            end = self._len
+        return self._slices(self._ids, max(start, 0), end)
+
+    def songs(self, start = 0, end = None):
+        '''
+        Return the songs of elements [`start`, `end`) as a list.
+        '''
+        if end is None:
+            end = self._len
+        return self._slices(self._songs, max(start, 0), end)
+
+    def trim(self, count):
+        '''
+        Remove the first `count` elements.
+        '''
+        count = min(count, self._len)
+        self._len -= count
+        while count > 0:
+            chunk = self._ids[0]
+            if len(chunk) <= count:
+                count -= len(chunk)
+                del self._ids[0]
+                if self._has_songs:
+                    del self._songs[0]
+            else:
+                del chunk[:count]
+                if self._has_songs:
+                    del self._songs[0][:count]
+                count = 0
+
+class Placement(object):
+    '''
+    Keeps track of the cost of inserting a new song into each gap of a
+    sequence, so that the best position can be found without re-scoring the
+    sequence. Gap `p` is the one immediately before element `p`, so there are
+    one more gaps than elements.
+
+    The cost of inserting into a gap has two parts:
+
+    - A cross term, which is independent of the new song. Every pair of
+      songs that straddles the gap is pushed one step further apart, which
+      changes its contribution to the energy.
+    - The left and right window sums, which are the repulsion between the new
+      song and its neighbours on either side of the gap.
+
+    The window sums are kept for each genre set ID that has been asked
+    about, as a total cost per gap. Inserting a song only affects gaps within
+    WINDOW of it, so keeping the costs up to date costs O(WINDOW) per
+    affected gap and ID, rather than a walk over the whole sequence.
+
+    :ivar sequence: genre set IDs for each song in the list
+    :vartype sequence: :py:class:`BlockedList`
+    :ivar list table: table of repulsion forces between genre set IDs (see
+      :py:class:`GenreSets`)
+    :ivar list cross: cross term for each gap
+    :ivar dict costs: total cost for each gap, indexed by genre set ID
+    :ivar int lookups: number of repulsion values looked up so far (for
+      benchmarking)
+    '''
+    def __init__(self, sequence, table):
+        self.sequence = BlockedList(sequence)
+        self.table = table
+        self.lookups = 0
+        self.cross = [0] * (len(self.sequence) + 1)
+        self._update_cross(1, len(self.sequence) + 1)
+        self.costs = {}
+        self._pending = {}     # Insertions not yet applied to costs, by ID
+
+    def _update_cross(self, start, end):
+        '''
+        Recompute the cross term for gaps in [`start`, `end`), given a correct
+        value for gap `start - 1`. Moving from gap `p` to gap `p + 1`, pairs
+        ending at element `p` stop straddling the gap and pairs starting there
+        begin to.
+        '''
+        table = self.table
+        cross = self.cross
+        n = len(self.sequence)
+        lo = max(0, start - 1 - WINDOW)
+        window = self.sequence.ids(lo, end + WINDOW)
+        value = cross[start - 1]
+        for p in range(start - 1, end - 1):
+            self.lookups += min(p, WINDOW) + min(n - 1 - p, WINDOW)
+            cur = window[p - lo]
+            row = table[cur]
+            for i in range(max(0, p - WINDOW), p):
+                value -= table[window[i - lo]][cur] * weight_deltas[p - i]
+            for j in range(p + 1, min(p + WINDOW + 1, n)):
+                value += row[window[j - lo]] * weight_deltas[j - p]
+            cross[p + 1] = value
+
+    def _cost(self, key, p, sequence):
+        '''
+        Compute the total cost of inserting a song with genre set ID `key`
+        into gap `p`, given the IDs in :py:attr:`sequence` as a list.
+        '''
+        table = self.table
+        row = table[key]
+        n = len(sequence)
+        self.lookups += min(p, WINDOW) + min(n - p, WINDOW)
+        ans = self.cross[p]
+        for i in range(max(0, p - WINDOW), p):
+            ans += table[sequence[i]][key] * weights[p - i]
+        for j in range(p, min(p + WINDOW, n)):
+            ans += row[sequence[j]] * weights[j - p + 1]
+        return ans
+
+    def scores(self, key, start):
+        '''
+        Return the cost of inserting a song with genre set ID `key` into each
+        gap from `start` onwards, relative to inserting it at `start`.
+        '''
+        costs = self.costs.get(key)
+        if costs is None:
+            sequence = self.sequence.ids()
+            costs = [self._cost(key, p, sequence) for p in range(len(sequence) + 1)]
+            self.costs[key] = costs
+        elif key in self._pending:
+            self._flush(key)
+        base = costs[start]
+        return [c - base for c in costs[start:]]
+
+    def pick(self, key, start, rng = random):
+        '''
+        Choose a gap from `start` onwards in which to insert a song with genre
+        set ID `key`, returning its offset from `start`. Ties are broken with
+        `rng`.
+        '''
+        return pick_smallest(enumerate(self.scores(key, start)), rng)
+
+    def trim(self, count):
+        '''
+        Forget the first `count` elements. The costs of the remaining gaps are
+        kept as they are, so they are only meaningful for gaps at least
+        2 * WINDOW elements from the new start (see :py:meth:`Generator.commit`).
+        '''
+        for key in list(self._pending):
+            self._flush(key)
+        self.sequence.trim(count)
+        del self.cross[:count]
+        for costs in self.costs.values():
+            del costs[:count]
+
+    def insert(self, pos, key):
+        '''
+        Insert a song with genre set ID `key` as element `pos`, and update the
+        costs of the gaps around it.
+
+        The costs are not updated straight away. Instead, the position is
+        noted, and the costs for each ID are brought up to date when it is
+        next asked for (see :py:meth:`_flush`). This saves work when the
+        insertions are close together, which is common when WINDOW is large,
+        or when an ID is not asked for again for a long time, as is common
+        for songs with several genres. If insertions pile up beyond the
+        length of the sequence, the costs are discarded instead.
+        '''
+        self.sequence.insert(pos, key)
+        self.cross.insert(pos + 1, None)
+        start = max(1, pos - WINDOW + 1)
+        end = min(pos + WINDOW + 1, len(self.sequence) + 1)
+        self._update_cross(start, end)
+        for k in list(self.costs):
+            pending = self._pending.setdefault(k, [])
+            pending.append(pos)
+            if len(pending) > len(self.sequence):
+                # Cheaper to start again if it is asked for
+                del self.costs[k]
+                del self._pending[k]
+
+    def _flush(self, key):
+        '''
+        Apply the insertions noted for `key` by :py:meth:`insert`. The gaps
+        around each insertion are marked as stale as it is replayed, and all
+        the stale gaps are then recomputed at once, so that each gap is
+        computed at most once however many insertions were close to it.
+        '''
+        costs = self.costs[key]
+        for pos in self._pending.pop(key):
+            costs.insert(pos + 1, None)
+            for p in range(max(0, pos - WINDOW), min(pos + WINDOW + 1, len(costs))):
+                costs[p] = None
+        sequence = None
+        for p, c in enumerate(costs):
+            if c is None:
+                if sequence is None:
+                    sequence = self.sequence.ids()
+                costs[p] = self._cost(key, p, sequence)
+
+def pick_smallest_array(values, rng = random):
+    '''
+    Equivalent to `pick_smallest(enumerate(values))` for a NumPy array,
+    including the calls it makes to the random number generator. Only the
+    elements that tie with the running minimum are visited in Python.
+    '''
+    if len(values) == 0:
+        return None
+    prev = np.minimum.accumulate(values)[:-1]
+    rest = values[1:]
+    ties = (np.flatnonzero(rest == prev) + 1).tolist()
+    lower = (np.flatnonzero(rest < prev) + 1).tolist()
+    best = 0
+    nbest = 1
+    j = 0
+    for k in ties:
+        while j < len(lower) and lower[j] < k:
+            best = lower[j]
+            nbest = 1
+            j += 1
+        if rng.randint(0, nbest) == 0:
+            best = k
+        nbest += 1
+    if j < len(lower):
+        best = lower[-1]
+    return best
+
+class NumpyPlacement(object):
+    '''
+    Alternative to :py:class:`Placement` that uses NumPy. Rather than
+    maintaining costs incrementally, it recomputes the cost of every gap on
+    each insertion, with one vectorized operation per offset in the window.
+
+    :ivar sequence: array of genre set IDs for each song in the list
+    :ivar list table: table of repulsion forces between genre set IDs (see
+      :py:class:`GenreSets`), which may grow as new IDs are allocated
+    :ivar int lookups: number of repulsion values looked up so far (for
+      benchmarking)
+    '''
+    def __init__(self, sequence, table):
+        self.sequence = np.array(sequence, dtype=np.intp)
+        self.table = table
+        self.lookups = 0
+        self._array = None
+        self._buffer = None
+        self._size = 0
+        self._cross = None
+
+    def _get_array(self):
+        '''
+        Return :py:attr:`table` as an array. When new IDs have been added,
+        only their rows and columns are copied, into a buffer that grows
+        geometrically, rather than converting the whole table again.
+        '''
+        table = self.table
+        n = len(table)
+        size = self._size
+        if n != size:
+            cols = np.array([row[size:n] for row in table])
+            buf = self._buffer
+            dtype = cols.dtype if buf is None else np.result_type(buf.dtype, cols.dtype)
+            if buf is None or n > len(buf) or dtype != buf.dtype:
+                capacity = max(n, 16 if buf is None else 2 * len(buf))
+                new = np.zeros((capacity, capacity), dtype)
+                if buf is not None:
+                    new[:size, :size] = buf[:size, :size]
+                buf = self._buffer = new
+            buf[:n, size:n] = cols
+            if size:
+                buf[size:n, :size] = np.array([row[:size] for row in table[size:]])
+            self._size = n
+            self._array = buf[:n, :n]
+        return self._array
+
+    def _get_cross(self):
+        '''
+        Compute the cross term for every gap (see :py:class:`Placement`).
+        The pair of elements `i` and `i + d` straddles gaps `i + 1` to
+        `i + d`, so each pair is added to a difference array at one end of
+        that range and subtracted at the other.
+        '''
+        if self._cross is None:
+            table = self._get_array()
+            s = self.sequence
+            n = len(s)
+            diff = np.zeros(n + 2, table.dtype)
+            for d in range(1, min(WINDOW, n - 1) + 1):
+                self.lookups += n - d
+                pairs = table[s[:n - d], s[d:]] * weight_deltas[d]
+                diff[1:n - d + 1] += pairs
+                diff[d + 1:n + 1] -= pairs
+            self._cross = np.cumsum(diff[:n + 1])
+        return self._cross
+
+    def costs(self, key):
+        '''
+        Return the total cost of inserting a song with genre set ID `key` into
+        each gap.
+        '''
+        table = self._get_array()
+        s = self.sequence
+        n = len(s)
+        left = table[s, key]
+        right = table[key, s]
+        self.lookups += 2 * n
+        ans = self._get_cross().copy()
+        for d in range(1, min(WINDOW, n) + 1):
+            ans[d:] += left[:n + 1 - d] * weights[d]
+            ans[:n + 1 - d] += right[d - 1:] * weights[d]
+        return ans
+
+    def scores(self, key, start):
+        costs = self.costs(key)[start:]
+        return (costs - costs[0]).tolist()
+
+    def pick(self, key, start, rng = random):
+        return pick_smallest_array(self.costs(key)[start:], rng)
+
+    def trim(self, count):
+        self.sequence = self.sequence[count:]
+        self._cross = None
+
+    def insert(self, pos, key):
+        self.sequence = np.insert(self.sequence, pos, key)
+        self._cross = None
+
+backends = {'python': Placement}
+if np is not None:
+    backends['numpy'] = NumpyPlacement
+    default_backend = 'numpy'
+else:
+    default_backend = 'python'
+
+class Stats(object):
+    '''
+    Optional instrumentation for a generation run. Pass an instance to
+    :py:class:`Generator` or :py:func:`generate_songs` to collect it; when no
+    instance is given, the only cost is a check per song.
+
+    The search for a position no longer calls :py:func:`score_pair`, so the
+    equivalent work is measured by `slots` and `lookups`.
+
+    :ivar dict phases: total wall time in seconds for each named phase (see :py:meth:`phase`)
+    :ivar int gets: number of calls to the factory's `get`
+    :ivar int exhausted: number of genres that ran out of songs
+    :ivar int slots: number of candidate positions evaluated
+    :ivar int lookups: number of repulsion values looked up
+    :ivar list latencies: wall time in seconds taken to generate and insert each song
+    '''
+    def __init__(self):
+        self.phases = {}
+        self.gets = 0
+        self.exhausted = 0
+        self.slots = 0
+        self.lookups = 0
+        self.latencies = []
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Context manager that adds the time spent inside it to phase `name`.
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.time() - start
+
+    def percentile(self, q):
+        '''
+        Return the `q`-th percentile (0 to 100) of :py:attr:`latencies`, or
+        `None` if there are none.
+        '''
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+    def report(self):
+        '''
+        Return a multi-line, human-readable summary.
+        '''
+        lines = ['{}: {:.3f}s'.format(name, self.phases[name]) for name in sorted(self.phases)]
+        lines.append('songs: {}, factory gets: {}, genres exhausted: {}'.format(
+            len(self.latencies), self.gets, self.exhausted))
+        lines.append('slots evaluated: {}, repulsion lookups: {}'.format(self.slots, self.lookups))
+        if self.latencies:
+            lines.append('insertion latency (ms): p50 {:.3f}, p90 {:.3f}, p99 {:.3f}, max {:.3f}'.format(
+                self.percentile(50) * 1000, self.percentile(90) * 1000,
+                self.percentile(99) * 1000, max(self.latencies) * 1000))
+        return '\n'.join(lines)
+
+def gap_costs(window, lo, gaps, key, table):
+    '''
+    Compute the cost of inserting a song with genre set ID `key` into each of
+    `gaps` directly, as the sum of the cross term and window sums described
+    in :py:class:`Placement`, without any incremental state. The cross term
+    costs O(WINDOW**2) for the first gap, and is then updated in O(WINDOW) for
+    each gap that follows the previous one.
+
+    :param list window: genre set IDs of the elements from `lo` onwards,
+      extending WINDOW elements either side of every gap (or to the ends of
+      the sequence)
+    :param list gaps: gaps to score, in increasing order
+    :return: list of costs, one per gap
+    '''
+    end = lo + len(window)
+    row = table[key]
+    ans = []
+    cross = None
+    prev = None
+    for p in gaps:
+        if prev is not None and p == prev + 1:
+            # As in Placement._update_cross
+            cur = window[prev - lo]
+            crow = table[cur]
+            for i in range(max(lo, prev - WINDOW), prev):
+                cross -= table[window[i - lo]][cur] * weight_deltas[prev - i]
+            for j in range(p, min(prev + WINDOW + 1, end)):
+                cross += crow[window[j - lo]] * weight_deltas[j - prev]
+        else:
+            cross = 0
+            for i in range(max(lo, p - WINDOW), p):
+                arow = table[window[i - lo]]
+                for j in range(p, min(i + WINDOW + 1, end)):
+                    cross += arow[window[j - lo]] * weight_deltas[j - i]
+        prev = p
+        cost = cross
+        for i in range(max(lo, p - WINDOW), p):
+            cost += table[window[i - lo]][key] * weights[p - i]
+        for j in range(p, min(p + WINDOW, end)):
+            cost += row[window[j - lo]] * weights[j - p + 1]
+        ans.append(cost)
     return ans
 
-def next_genre(N, seen, freqs):
-    target = {}
-    for g in freqs:
-        target[g] = seen.get(g, 0) - (N + 1) * freqs[g]
-    return pick_smallest(target.items())
+class SlotSearch(object):
+    '''
+    Limits the gaps that :py:class:`Generator` considers for each new song,
+    so that the time per song does not grow with the length of the list.
+    The candidate gaps are chosen by `mode`:
+
+    - `tail`: the last `count` gaps
+    - `sample`: `count` gaps drawn at random, one from each of `count`
+      equal strata of the uncommitted songs
+    - `sparse`: `count` gaps centred on the middle of the longest stretch of
+      uncommitted songs that share none of the new song's genres. Finding it
+      takes a scan of the genre set IDs, which is much cheaper than scoring
+      every gap, but still O(N).
+
+    Each candidate is scored with :py:func:`gap_costs`. When there are no
+    more gaps than `count`, the full search is used instead.
+
+    If a time budget is given, `count` is adjusted after each song, from a
+    running estimate of the time taken per candidate, so that the search
+    takes about the budget. This makes the choices depend on timing.
 
-def generate_songs(freqs, repel, duration, factory, prefix = []):
+    To measure what the limit costs, every `audit` songs the full search is
+    also run (without affecting the choice), and the difference between the
+    chosen gap and the best gap is added to :py:attr:`regret`. Those songs
+    take as long as a full search, which shows in the latency percentiles
+    unless `audit` is large or 0.
+
+    :param str mode: `tail`, `sample` or `sparse`
+    :param int count: number of candidates (the starting number, if there is
+      a time budget)
+    :param per_song: time budget per song, in seconds
+    :param total: time budget for all the songs, in seconds. It is spread over
+      the songs that :py:meth:`Generator.extend` expects to generate.
+    :param int audit: interval between songs checked against the full
+      search, or 0 to never check
+
+    :ivar int songs: number of songs placed
+    :ivar int full: number of songs for which the full search was used
+    :ivar int candidates: total number of candidates scored
+    :ivar spent: total time spent searching, in seconds (excluding audits)
+    :ivar int audited: number of songs checked against the full search
+    :ivar regret: total energy given up at the audited songs
+    :raise ValueError: if `mode` is not known
+    '''
+    MODES = ('tail', 'sample', 'sparse')
+    # Fewest candidates a time budget may reduce the search to
+    MIN_COUNT = 4
+
+    def __init__(self, mode, count = 64, per_song = None, total = None, audit = 64):
+        if mode not in self.MODES:
+            raise ValueError('Unknown slot search mode {!r}'.format(mode))
+        self.mode = mode
+        self.count = max(1, count)
+        self.per_song = per_song
+        self.total = total
+        self.audit = audit
+        self.songs = 0
+        self.full = 0
+        self.candidates = 0
+        self.spent = 0.0
+        self.audited = 0
+        self.regret = 0
+        self.last = 0          # Candidates scored for the last song
+        self._expected = None  # Songs still to come, for the total budget
+        self._per_candidate = None
+
+    def expect(self, songs):
+        '''
+        Set the number of songs still to be generated, over which the
+        `total` budget is spread.
+        '''
+        self._expected = songs
+
+    def _budget(self):
+        if self.per_song is not None:
+            return self.per_song
+        if self.total is not None and self._expected:
+            return max(0.0, self.total - self.spent) / self._expected
+        return None
+
+    def _candidates(self, items, sets, key, start, count, rng):
+        '''
+        Return the candidate gaps, in increasing order.
+
+        :param sets: the generator's genre sets
+        :type sets: :py:class:`GenreSets`
+        '''
+        n = len(items)
+        if self.mode == 'tail':
+            return list(range(n + 1 - count, n + 1))
+        elif self.mode == 'sample':
+            gaps = n + 1 - start
+            return [rng.randrange(start + s * gaps // count, start + (s + 1) * gaps // count)
+                    for s in range(count)]
+        else:
+            # Every genre set that has one of the song's genres, including its own
+            genres = set(sets.sets[key])
+            shared = set(i for (i, other) in enumerate(sets.sets) if not genres.isdisjoint(other))
+            ids = items.ids(start)
+            bounds = [-1] + [i for (i, x) in enumerate(ids) if x in shared] + [len(ids)]
+            width, a = max((bounds[k + 1] - bounds[k], bounds[k]) for k in range(len(bounds) - 1))
+            first = start + a + (width + 1) // 2 - count // 2
+            first = min(max(first, start), n + 1 - count)
+            return list(range(first, first + count))
+
+    def pick(self, gen, key, start):
+        '''
+        Choose a gap for a song with genre set ID `key`, as for
+        :py:meth:`Placement.pick`.
+
+        :param gen: the generator
+        :type gen: :py:class:`Generator`
+        '''
+        begin = time.time()
+        items = gen.items
+        count = self.count
+        if count >= len(items) + 1 - start:
+            place = gen.placement.pick(key, start, gen.rng)
+            self.full += 1
+            self.last = len(items) + 1 - start
+        else:
+            gaps = self._candidates(items, gen.sets, key, start, count, gen.rng)
+            table = gen.sets.table
+            costs = []
+            i = 0
+            while i < len(gaps):
+                # Gaps close enough together share one window
+                j = i + 1
+                while j < len(gaps) and gaps[j] - gaps[j - 1] <= 2 * WINDOW:
+                    j += 1
+                lo = max(0, gaps[i] - WINDOW)
+                window = items.ids(lo, gaps[j - 1] + WINDOW)
+                costs.extend(gap_costs(window, lo, gaps[i:j], key, table))
+                i = j
+            gen.placement.lookups += len(gaps) * (WINDOW * (WINDOW + 1) // 2 + 2 * WINDOW)
+            place = pick_smallest(zip(gaps, costs), gen.rng) - start
+            self.last = count
+            elapsed = time.time() - begin
+            per = elapsed / count
+            if self._per_candidate is None:
+                self._per_candidate = per
+            else:
+                self._per_candidate = 0.8 * self._per_candidate + 0.2 * per
+            budget = self._budget()
+            if budget is not None:
+                self.count = max(self.MIN_COUNT, int(budget / self._per_candidate))
+        self.spent += time.time() - begin
+        self.songs += 1
+        self.candidates += self.last
+        if self._expected:
+            self._expected -= 1
+        if self.audit and self.songs % self.audit == 0:
+            scores = gen.placement.scores(key, start)
+            self.regret += scores[place] - min(scores)
+            self.audited += 1
+        return place
+
+    def report(self):
+        '''
+        Return a multi-line, human-readable summary.
+        '''
+        lines = ['slot search ({}): {} songs, {:.1f} candidates per song, {} full searches, {:.3f}s'.format(
+            self.mode, self.songs, self.candidates / max(1, self.songs), self.full, self.spent)]
+        if self.audited:
+            lines.append('energy given up: {} over {} audited songs ({:.1f} per song)'.format(
+                self.regret, self.audited, self.regret / self.audited))
+        return '\n'.join(lines)
+
+def _rng_state(state, sequence = list):
+    '''
+    Convert the state of a :py:class:`random.Random` between the nested
+    tuples it uses and nested lists, which survive a round trip through
+    :py:mod:`json`.
+    '''
+    if isinstance(state, (tuple, list)):
+        return sequence(_rng_state(x, sequence) for x in state)
+    return state
+
+def _normalize(freqs):
+    '''
+    Return a copy of `freqs` scaled to sum to 1.
+
+    :raise ValueError: if the sum of frequencies is not positive
+    '''
+    freqs = dict(freqs) # Make a copy to avoid modifying the caller's copy
+    tfreq = sum(freqs.values())
+    if tfreq <= 0.0:
+        raise ValueError('Must have at least one non-zero frequency')
+    for g in freqs.keys():
+        freqs[g] /= tfreq
+    return freqs
+
+def _refine_order(items, start, table, budget, max_moves, rng):
+    '''
+    Run :py:func:`refine_sequence` over the songs in a :py:class:`BlockedList`
+    from `start` onwards, without moving them. The moves use a generator
+    seeded from `rng`, so that exactly one value is drawn from `rng`.
+
+    :return: tuple of the change in energy and the new order of the songs,
+      as for :py:meth:`Generator.reorder`
+    '''
+    sequence = items.ids()
+    order = list(range(len(sequence) - start))
+    moves = random.Random(rng.getrandbits(32))
+    delta = refine_sequence(sequence, table, start, budget, order, max_moves, moves)
+    return delta, order
+
+def _reordered(items, start, order):
+    '''
+    Return a copy of a :py:class:`BlockedList` with the elements from `start`
+    onwards rearranged by `order`.
+    '''
+    ids = items.ids()
+    songs = items.songs()
+    return BlockedList(ids[:start] + [ids[start + i] for i in order],
+                       songs[:start] + [songs[start + i] for i in order])
+
+class Generator(object):
+    '''
+    Incremental form of :py:func:`generate_songs`. Songs are generated one at
+    a time by :py:meth:`step`. Since each new song may be inserted anywhere
+    after the prefix, the list is not final until :py:meth:`commit` is called,
+    which hands back songs from the front of the list and makes them part of
+    the prefix. Frequency targets carry over across commits.
+
+    Only the last 2 * WINDOW songs of the prefix can affect where new songs
+    go, so older ones are forgotten. The cost of each step and the memory use
+    are thus bounded by the number of uncommitted songs, however long the
+    generator runs.
+
+    The state of a generator can be saved with :py:meth:`get_state` and
+    recreated with :py:meth:`restore`, so that generation can be picked up
+    later where it left off, keeping the frequency balance built up so far.
+
+    The parameters are as for :py:func:`generate_songs`. If the factory uses
+    random numbers, it should share `rng` with the generator, so that
+    :py:meth:`get_state` captures both (but see :py:mod:`replay`).
+
+    :ivar items: the songs in :py:attr:`recent` and :py:attr:`songs`, with
+      their genre set IDs
+    :vartype items: :py:class:`BlockedList`
+    :ivar list songs: songs generated since the last commit, in order (a
+      copy taken from :py:attr:`items`)
+    :ivar list recent: the songs at the end of the prefix that can still
+      affect where new songs go (also a copy)
+    :ivar duration: total duration of songs generated so far (including
+      committed songs, but not songs generated before a :py:meth:`restore`)
+    :ivar pending_duration: total duration of the songs in :py:attr:`songs`
+    :ivar dict freqs: normalized frequency of each genre not yet exhausted
+    :ivar dict seen: number of songs generated for each genre
+    :ivar queue: chooses the next genre
+    :vartype queue: :py:class:`GenreQueue`
+    :ivar int prefix_len: number of songs before the insertion region
+    :ivar stats: instrumentation, if enabled
+    :vartype stats: :py:class:`Stats`
+    :ivar rng: source of random numbers
+    :ivar trace: recorder for decisions, if enabled
+    :ivar search: limit on the gaps considered, if any
+    :vartype search: :py:class:`SlotSearch`
+
+    :raise ValueError: if the sum of frequencies is not positive
+    '''
+    # Songs may be inserted anywhere after the prefix, until they are committed
+    append_only = False
+
+    def __init__(self, freqs, repel, factory, prefix = [], backend = None, stats = None,
+                 rng = None, trace = None, search = None):
+        freqs = _normalize(freqs)
+        self.freqs = freqs
+        self.seen = {g: 0 for g in freqs}
+        self.rng = rng if rng is not None else random
+        self.queue = GenreQueue(freqs, self.seen, self.rng)
+        self.factory = factory
+
+        self.sets = GenreSets(repel, freqs)
+        if backend is None:
+            backend = default_backend
+        self._backend = backends[backend]
+        sequence = [self.sets.intern(factory.get_genres(x)) for x in prefix]
+        self.placement = self._backend(sequence, self.sets.table)
+        self.items = BlockedList(sequence, prefix)
+        self.prefix_len = len(prefix)
+        self.duration = 0
+        self.pending_duration = 0
+        self._dropped = 0     # Songs trimmed from the front of the placement
+        self.stats = stats
+        self.trace = trace
+        self.search = search
+
+    @property
+    def songs(self):
+        return self.items.songs(self.prefix_len - self._dropped)
+
+    @property
+    def recent(self):
+        return self.items.songs(0, self.prefix_len - self._dropped)
+
+    @property
+    def pending(self):
+        '''Number of songs generated since the last commit'''
+        return len(self.items) - (self.prefix_len - self._dropped)
+
+    def get_state(self, genres):
+        '''
+        Return the state of the generator, made up only of lists, numbers and
+        strings apart from the songs, so that it can be saved with
+        :py:mod:`json` or :py:mod:`pickle` if the songs can. It holds:
+
+        - `freqs`, `seen`, `queue`: the state of the genre choice
+        - `sets`: the genre set of each ID used in `sequence`
+        - `sequence`: genre set IDs of the songs in :py:attr:`recent` and
+          :py:attr:`songs`, in order
+        - `recent`, `songs`: the songs themselves
+        - `rng`: the state of :py:attr:`rng`
+
+        The state of the factory is not included.
+
+        :param list genres: every genre that the generator may see. Genres
+          are saved as indices into this list.
+        '''
+        index = {g: i for (i, g) in enumerate(genres)}
+        return {
+            'freqs': [[index[g], f] for (g, f) in self.freqs.items()],
+            'seen': [[index[g], n] for (g, n) in self.seen.items()],
+            'queue': self.queue.get_state(index),
+            'sets': [[index[g] for g in key] for key in self.sets.sets],
+            'sequence': self.items.ids(),
+            'recent': self.recent,
+            'songs': self.songs,
+            'rng': _rng_state(self.rng.getstate())
+        }
+
+    @classmethod
+    def restore(cls, state, genres, repel, factory, backend = None, stats = None, rng = None):
+        '''
+        Recreate a generator from :py:meth:`get_state`. It continues exactly
+        as the original would have done, provided that the factory is also
+        in the same state. The songs in `recent` become the prefix.
+
+        :param state: the state
+        :param list genres: the genres, in the order passed to :py:meth:`get_state`
+        :param rng: random number generator to load the saved state into.
+          If not given, a new :py:class:`random.Random` is created.
+
+        The other parameters are as for the constructor.
+        '''
+        self = cls.__new__(cls)
+        self.freqs = {genres[g]: f for (g, f) in state['freqs']}
+        self.seen = {genres[g]: n for (g, n) in state['seen']}
+        self.rng = rng if rng is not None else random.Random()
+        self.rng.setstate(_rng_state(state['rng'], tuple))
+        self.queue = GenreQueue.restore(self.freqs, self.seen, state['queue'], genres, self.rng)
+        self.factory = factory
+
+        self.sets = GenreSets(repel)
+        for key in state['sets']:
+            self.sets.intern([genres[g] for g in key])
+        if backend is None:
+            backend = default_backend
+        self._backend = backends[backend]
+        self.placement = self._backend(state['sequence'], self.sets.table)
+        self.items = BlockedList(state['sequence'], list(state['recent']) + list(state['songs']))
+        self.prefix_len = len(state['recent'])
+        self.duration = self.pending_duration = sum(factory.get_duration(x) for x in state['songs'])
+        self._dropped = 0
+        self.stats = stats
+        self.trace = None
+        self.search = None
+        return self
+
+    def step(self):
+        '''
+        Generate one more song and insert it into :py:attr:`songs`.
+
+        :return: the new song, or `None` if every genre has been exhausted
+        '''
+        stats = self.stats
+        if stats is None:
+            return self._step()
+
+        start = time.time()
+        lookups = self.placement.lookups
+        genres = len(self.freqs)
+        song = self._step()
+        exhausted = genres - len(self.freqs)
+        stats.exhausted += exhausted
+        stats.gets += exhausted
+        if song is not None:
+            stats.gets += 1
+            stats.slots += self.pending if self.search is None else self.search.last
+            stats.lookups += self.placement.lookups - lookups
+            stats.latencies.append(time.time() - start)
+        return song
+
+    def _step(self):
+        factory = self.factory
+        queue = self.queue
+        while queue:
+            g = queue.peek()
+            song = factory.get(g)
+            if song is None:
+                # Exhausted that genre
+                if self.trace is not None:
+                    self.trace.choice(g, None, None)
+                queue.remove()
+                continue
+            queue.advance()
+
+            key = self.sets.intern(factory.get_genres(song))
+            start = self.prefix_len - self._dropped
+            if self.search is None:
+                place = self.placement.pick(key, start, self.rng)
+            else:
+                place = self.search.pick(self, key, start)
+            if self.trace is not None:
+                self.trace.choice(g, song, place)
+            self.placement.insert(place + start, key)
+            self.items.insert(place + start, key, song)
+            song_duration = factory.get_duration(song)
+            self.duration += song_duration
+            self.pending_duration += song_duration
+            return song
+        return None
+
+    def extend(self, duration):
+        '''
+        Generate songs until the total duration reaches `duration`, or every
+        genre is exhausted.
+        '''
+        while self.duration < duration:
+            if self.search is not None and self.pending and self.pending_duration > 0:
+                # Spread the search's total budget over the songs still to come
+                mean = self.pending_duration / self.pending
+                self.search.expect(int(math.ceil((duration - self.duration) / mean)))
+            if self.step() is None:
+                break
+
+    def refine(self, budget, max_moves = None):
+        '''
+        Improve the order of the uncommitted songs with
+        :py:func:`refine_sequence`. Committed songs and the prefix are not
+        moved.
+
+        The moves use a generator seeded from :py:attr:`rng`, so that the
+        number of values drawn from :py:attr:`rng` does not depend on how
+        many moves fit in the budget.
+
+        :param budget: time limit in seconds
+        :param int max_moves: if given, stop after this many moves
+        :return: the change in energy (zero or negative)
+        '''
+        delta, order = _refine_order(self.items, self.prefix_len - self._dropped,
+                                     self.sets.table, budget, max_moves, self.rng)
+        if delta:
+            self.reorder(order)
+        if self.trace is not None:
+            self.trace.refine(order if delta else None)
+        return delta
+
+    def reorder(self, order):
+        '''
+        Rearrange the uncommitted songs, so that position `k` of
+        :py:attr:`songs` receives the song that was at position `order[k]`.
+        This is how :py:meth:`refine` applies its result, and lets
+        :py:mod:`replay` apply a recorded one.
+        '''
+        self.items = _reordered(self.items, self.prefix_len - self._dropped, order)
+        # The placement's incremental state no longer matches, so start again
+        lookups = self.placement.lookups
+        self.placement = self._backend(self.items.ids(), self.sets.table)
+        self.placement.lookups = lookups
+
+    def commit(self, count = None):
+        '''
+        Make songs at the front of the list final. They become part of the
+        prefix, so later songs are only inserted after them.
+
+        :param int count: number of songs to commit (defaults to all of them)
+        :return: the newly committed songs
+        '''
+        start = self.prefix_len - self._dropped
+        if count is None:
+            count = self.pending
+        songs = self.items.songs(start, start + count)
+        self.prefix_len += len(songs)
+        for song in songs:
+            self.pending_duration -= self.factory.get_duration(song)
+        if self.trace is not None:
+            self.trace.commit(len(songs))
+        excess = self.prefix_len - self._dropped - 2 * WINDOW
+        if excess > 0:
+            self.placement.trim(excess)
+            self.items.trim(excess)
+            self._dropped += excess
+        return songs
+
+class BeamGenerator(object):
+    '''
+    Alternative to :py:class:`Generator` that builds the list from left to
+    right, only ever appending. Instead of trying every position for each
+    new song, it keeps a beam of the best few ways to continue the list,
+    each a short run of genres not yet drawn from the factory. At each
+    step, every run in the beam is extended by each of the genres that are
+    due soonest, using the same due positions as :py:class:`GenreQueue`,
+    and the cheapest runs are kept. Once the runs are `depth` long, the
+    first genre of the cheapest run is final: a song is drawn for it, and
+    runs that started differently are dropped.
+
+    Appending a genre only adds the repulsion between it and the last WINDOW
+    songs, so a step costs O(beam * branch * WINDOW), however long the list
+    is. Songs are final as soon as they are generated, which suits
+    :py:func:`stream_songs`.
+
+    To keep the frequency targets, a genre that is overdue by WINDOW songs
+    or more must be chosen next. A genre with zero frequency is only chosen
+    once all other genres are exhausted. Until a song has been drawn for a
+    genre, it is scored as if it had only that genre.
+
+    The interface is the same as :py:class:`Generator` (apart from saving
+    state), and the parameters are as for :py:func:`generate_songs`, plus:
+
+    :param int beam: number of runs kept
+    :param int depth: length of the runs, which is how far ahead each choice
+      looks
+    :param int branch: number of genres tried to extend each run
+    '''
+    append_only = True
+
+    def __init__(self, freqs, repel, factory, prefix = [], backend = None, stats = None,
+                 rng = None, trace = None, search = None, beam = 8, depth = 4, branch = 3):
+        self.freqs = _normalize(freqs)
+        self.seen = {g: 0 for g in self.freqs}
+        self.rng = rng if rng is not None else random
+        self.factory = factory
+        self.sets = GenreSets(repel, self.freqs)
+        self.search = None    # Only appends, so there is no search to limit
+        prefix = prefix[-WINDOW:]
+        self.items = BlockedList([self.sets.intern(factory.get_genres(x)) for x in prefix], prefix)
+        self._start = len(prefix)   # Songs in items that are committed or from the prefix
+        self.duration = 0
+        self.pending_duration = 0
+        self.stats = stats
+        self.trace = trace
+        self.beam = beam
+        self.depth = depth
+        self.branch = branch
+        self.count = 0         # Songs generated
+        self._order = {g: i for (i, g) in enumerate(self.freqs)}  # Avoids comparing genres
+        self._current = {}     # Valid heap entry for each genre
+        self._heap = []
+        for g in self.freqs:
+            self._push(g)
+        self._runs = [(0, (), ())]
+
+    @property
+    def songs(self):
+        return self.items.songs(self._start)
+
+    @property
+    def pending(self):
+        return len(self.items) - self._start
+
+    def _due(self, genre, extra = 0):
+        freq = self.freqs[genre]
+        return (self.seen[genre] + extra + 1) / freq if freq > 0 else float('inf')
+
+    def _push(self, genre):
+        entry = (self._due(genre), self.rng.random(), self._order[genre], genre)
+        self._current[genre] = entry
+        heapq.heappush(self._heap, entry)
+
+    def _soonest(self, count):
+        '''
+        Return the heap entries of up to `count` genres that are due soonest.
+        Entries for exhausted genres, and superseded entries, are dropped
+        from the heap as they are found.
+        '''
+        heap = self._heap
+        ans = []
+        while heap and len(ans) < count:
+            entry = heapq.heappop(heap)
+            if self._current.get(entry[3]) is entry:
+                ans.append(entry)
+        for entry in ans:
+            heapq.heappush(heap, entry)
+        return ans
+
+    def _choices(self, soonest, run):
+        '''
+        Return the genres to try after `run`, given the `soonest` entries
+        before any of the run was chosen. The run can only have pushed back
+        the due positions of at most `depth` of them, so enough of the rest
+        are unaffected for this to be the true set of soonest genres.
+        '''
+        entries = []
+        for entry in soonest:
+            extra = run.count(entry[3])
+            if extra:
+                entry = (self._due(entry[3], extra),) + entry[1:]
+            entries.append(entry)
+        entries.sort()
+        if self.count + len(run) + 1 - entries[0][0] >= WINDOW:
+            return [entries[0][3]]      # Overdue
+        ans = [e[3] for e in entries[:self.branch] if e[0] != float('inf')]
+        return ans or [entries[0][3]]
+
+    def _extend_runs(self):
+        table = self.sets.table
+        soonest = self._soonest(self.branch + self.depth)
+        base = self.items.ids(len(self.items) - WINDOW)
+        expanded = []
+        for cost, run, run_ids in self._runs:
+            window = (base + list(run_ids))[-WINDOW:]
+            n = len(window)
+            for g in self._choices(soonest, run):
+                x = self.sets.intern([g])
+                added = 0
+                for d in range(1, n + 1):
+                    added += table[window[n - d]][x] * weights[d]
+                expanded.append((cost + added, self.rng.random(), run + (g,), run_ids + (x,)))
+        if self.stats is not None:
+            self.stats.slots += len(expanded)
+            self.stats.lookups += len(expanded) * WINDOW
+        self._runs = [(c, run, run_ids) for (c, r, run, run_ids) in heapq.nsmallest(self.beam, expanded)]
+
+    def _decide(self):
+        '''
+        Draw a song for the first genre of the best run.
+
+        :return: the song, or `None` if the genre turned out to be exhausted
+        '''
+        run = self._runs[0][1]
+        g = run[0]
+        song = self.factory.get(g)
+        if self.trace is not None:
+            self.trace.choice(g, song, self.pending if song is not None else None)
+        if song is None:
+            del self.freqs[g]
+            del self._current[g]
+            self._runs = [(0, (), ())]
+            return None
+        self.seen[g] += 1
+        self._push(g)
+        self._runs = [(c, r[1:], ids[1:]) for (c, r, ids) in self._runs if r[0] is g]
+        self.items.append(self.sets.intern(self.factory.get_genres(song)), song)
+        self.count += 1
+        song_duration = self.factory.get_duration(song)
+        self.duration += song_duration
+        self.pending_duration += song_duration
+        return song
+
+    def step(self):
+        '''
+        Generate one more song and append it to :py:attr:`songs`.
+
+        :return: the new song, or `None` if every genre has been exhausted
+        '''
+        stats = self.stats
+        start = time.time()
+        genres = len(self.freqs)
+        song = None
+        while song is None and self.freqs:
+            if len(self._runs[0][1]) < self.depth:
+                self._extend_runs()
+            else:
+                song = self._decide()
+        if stats is not None:
+            exhausted = genres - len(self.freqs)
+            stats.exhausted += exhausted
+            stats.gets += exhausted
+            if song is not None:
+                stats.gets += 1
+                stats.latencies.append(time.time() - start)
+        return song
+
+    def extend(self, duration):
+        '''
+        Generate songs until the total duration reaches `duration`, or every
+        genre is exhausted.
+        '''
+        while self.duration < duration:
+            if self.step() is None:
+                break
+
+    def refine(self, budget, max_moves = None):
+        '''
+        Improve the order of the uncommitted songs, as for
+        :py:meth:`Generator.refine`.
+        '''
+        delta, order = _refine_order(self.items, self._start, self.sets.table, budget,
+                                     max_moves, self.rng)
+        if delta:
+            self.reorder(order)
+        if self.trace is not None:
+            self.trace.refine(order if delta else None)
+        return delta
+
+    def reorder(self, order):
+        '''
+        Rearrange the uncommitted songs, as for :py:meth:`Generator.reorder`.
+        '''
+        self.items = _reordered(self.items, self._start, order)
+        self._runs = [(0, (), ())]     # Scored against the old order
+
+    def commit(self, count = None):
+        '''
+        Hand back songs from the front of :py:attr:`songs`, as for
+        :py:meth:`Generator.commit`.
+        '''
+        start = self._start
+        if count is None:
+            count = self.pending
+        songs = self.items.songs(start, start + count)
+        start += len(songs)
+        excess = start - WINDOW
+        if excess > 0:
+            self.items.trim(excess)
+            start -= excess
+        self._start = start
+        for song in songs:
+            self.pending_duration -= self.factory.get_duration(song)
+        if self.trace is not None:
+            self.trace.commit(len(songs))
+        return songs
+
+# Ways of building the list, for the strategy parameter of generate_songs
+strategies = {'insert': Generator, 'beam': BeamGenerator}
+
+def generate_songs(freqs, repel, duration, factory, prefix = [], backend = None, stats = None,
+                   refine = None, strategy = 'insert', rng = None, trace = None, search = None):
     '''
     Generate a sequence of a given length. Each element is one of the genres,
     and `freqs` gives the relative frequency of each genre. The frequencies
@@ -157,52 +1778,303 @@ def generate_songs(freqs, repel, duration, factory, prefix = []):
            Return the genres corresponding to a song returned by :py:func:`get`.
 
     :param prefix: sequence of songs already in the play queue
+    :param str backend: key in :py:data:`backends` selecting the implementation
+      of the search, or `None` to use :py:data:`default_backend`
+    :param stats: if given, instrumentation is collected into it, including
+      a `generate` phase covering the whole call
+    :type stats: :py:class:`Stats`
+    :param refine: if given, spend up to this many seconds improving the
+      result with :py:meth:`Generator.refine`
+    :param str strategy: key in :py:data:`strategies` selecting how the list
+      is built: `insert` (the default) inserts each song at the best position
+      with :py:class:`Generator`, and `beam` appends songs with
+      :py:class:`BeamGenerator`, which is less thorough but takes the same
+      time per song however long the list is. The `backend` only applies to
+      `insert`.
+    :param rng: source of random numbers (such as a seeded
+      :py:class:`random.Random`), which defaults to the :py:mod:`random`
+      module
+    :param trace: if given, each call to the factory's `get` and the
+      position chosen for the song are reported to it, as are commits and
+      refinements (see :py:class:`replay.TraceRecorder`)
+    :param search: if given, limits the positions considered for each song,
+      to bound the time per song on long lists. Like `backend`, it only
+      applies to `insert`.
+    :type search: :py:class:`SlotSearch`
 
     :raise ValueError: if the sum of frequencies is not positive
     '''
 
-    freqs = dict(freqs) # Make a copy to avoid modifying the caller's copy
-    # Normalize the frequencies to sum to 1
-    tfreq = sum(freqs.values())
-    if tfreq <= 0.0:
+    gen = strategies[strategy](freqs, repel, factory, prefix, backend, stats, rng, trace, search)
+    if stats is None:
+        gen.extend(duration)
+    else:
+        with stats.phase('generate'):
+            gen.extend(duration)
+    if refine:
+        if stats is None:
+            gen.refine(refine)
+        else:
+            with stats.phase('refine'):
+                gen.refine(refine)
+    return gen.songs
+
+# Inputs shared by the trials of generate_best, set in each worker process
+_trial_state = None
+
+def _init_trial(state):
+    '''
+    Set up :py:func:`_run_trial` in this process, from the plain state built
+    by :py:func:`generate_best`. Genres are replaced by numbers, and the
+    factory by a :py:class:`library.Factory` on a copy of the durations and
+    genres of the songs.
+    '''
+    global _trial_state
+    if state is None:
+        _trial_state = None
+        return
+    genres = len(state['repel'])
+    freqs = collections.OrderedDict((g, f) for (g, f) in state['freqs'])
+    repel = {(a, b): state['repel'][a][b] for a in range(genres) for b in range(genres)}
+    factory = library.Factory.from_portable_state(state['factory'])
+    _trial_state = (freqs, repel, state['duration'], factory, state['prefix'], state['backend'])
+
+def _run_trial(seed):
+    '''
+    Run one trial for :py:func:`generate_best`, drawing all its random
+    numbers from a :py:class:`random.Random` seeded with `seed`. The factory
+    is rolled back afterwards, so that the next trial in the same process
+    starts afresh.
+
+    :return: tuple of (score, songs, numbers of the missing genres)
+    '''
+    freqs, repel, duration, factory, prefix, backend = _trial_state
+    mark = factory.mark()
+    rng = random.Random(seed)
+    factory.rng = rng
+    try:
+        gen = Generator(freqs, repel, factory, prefix, backend, rng = rng)
+        gen.extend(duration)
+        sequence = [gen.sets.intern(factory.get_genres(x)) for x in list(prefix) + gen.songs]
+        return (score(sequence, gen.sets.table), gen.songs, factory.missing[mark[1]:])
+    finally:
+        factory.rollback(mark)
+
+def _trial_process(state, seed, index, results):
+    '''
+    Entry point of a worker process of :py:func:`generate_best`, which runs
+    one trial and puts its index and result on the queue `results`.
+    '''
+    _init_trial(state)
+    results.put((index, _run_trial(seed)))
+
+@contextmanager
+def _trial_path():
+    # Lets a worker started afresh import this module by its own name
+    here = os.path.dirname(os.path.abspath(__file__))
+    added = here not in sys.path
+    if added:
+        sys.path.append(here)
+    try:
+        yield
+    finally:
+        if added:
+            sys.path.remove(here)
+
+def _trial_module():
+    '''
+    Return this module as imported under its own name, rather than as part
+    of the plugin package, so that a worker process started afresh only
+    imports it and :py:mod:`library`. Importing the package would import
+    Rhythmbox. Return `None` if another module already has the name.
+    '''
+    if __name__ == 'generator':
+        return sys.modules[__name__]
+    module = sys.modules.get('generator')
+    if module is None:
+        with _trial_path():
+            module = importlib.import_module('generator')
+    here = os.path.dirname(os.path.abspath(__file__))
+    if os.path.dirname(os.path.abspath(getattr(module, '__file__', ''))) != here:
+        return None
+    return module
+
+def _trial_context():
+    '''
+    Return the :py:mod:`multiprocessing` context for the workers of
+    :py:func:`generate_best`. Forking a process that has other threads (such
+    as Rhythmbox) is unsafe, so the workers are spawned where possible.
+    Python 2 can only fork.
+    '''
+    if not hasattr(multiprocessing, 'get_context'):
+        return multiprocessing
+    return multiprocessing.get_context('spawn')
+
+def _run_trial_processes(state, seeds, processes, deadline, cancelled, results):
+    '''
+    Run the trials of :py:func:`generate_best` in worker processes, one
+    process per trial and at most `processes` at a time, storing the result
+    of each in `results` by its index in `seeds`.
+
+    :return: `'done'` once every trial has run (or the deadline has passed),
+      `'cancelled'` if `cancelled` returned true, or `'failed'` if a worker
+      died without a result (such as when it could not import this module)
+    '''
+    module = _trial_module()
+    if module is None:
+        return 'failed'
+    context = _trial_context()
+    queue = context.Queue()
+    running = {}
+    limit = len(seeds)
+    launched = 0
+    try:
+        while running or launched < limit:
+            while launched < limit and len(running) < processes:
+                if launched and deadline is not None and time.time() >= deadline:
+                    limit = launched
+                    break
+                process = context.Process(target = module._trial_process,
+                                          args = (state, seeds[launched], launched, queue))
+                process.daemon = True
+                with _trial_path():
+                    process.start()
+                running[launched] = process
+                launched += 1
+            if not running:
+                break
+            try:
+                index, result = queue.get(True, 0.1)
+            except Empty:
+                if cancelled is not None and cancelled():
+                    return 'cancelled'
+                if any(process.exitcode not in (None, 0) for process in running.values()):
+                    return 'failed'
+                continue
+            results[index] = result
+            running.pop(index).join()
+        return 'done'
+    finally:
+        for process in running.values():
+            process.terminate()
+            process.join()
+
+def generate_best(freqs, repel, duration, factory, prefix = [], trials = 4, budget = None,
+                  processes = None, backend = None, rng = random, cancelled = None):
+    '''
+    Run :py:func:`generate_songs` several times with different random seeds,
+    and return the songs from the trial with the lowest :py:func:`score`.
+    Ties in the heuristic are broken randomly, so the quality of a single run
+    is partly luck.
+
+    The trials run in worker processes, which are started afresh rather than
+    forked where possible. Each trial has an integer seed, from which it
+    makes its own random number generator for both the generator and the
+    factory. The workers are sent only lists and numbers: genres are
+    replaced by numbers, and the factory by its portable state (see
+    :py:meth:`library.Factory.get_portable_state`), so a worker needs
+    neither Rhythmbox nor the plugin package. If a worker dies without a
+    result, the remaining trials run in this process instead. Once a winner
+    is chosen, its songs are removed from `factory` with `take`, so that the
+    caller sees the same state as if the winner had run directly.
+
+    The factory must be a :py:class:`library.Factory`, and `prefix` must be
+    songs in its snapshot. `repel` must give the repulsion between every pair
+    of genres of the songs.
+
+    :param int trials: maximum number of trials to run
+    :param budget: wall-clock time in seconds after which no more trials are
+      started (the first is always started). `None` means no limit.
+    :param int processes: number of worker processes (defaults to the number
+      of CPUs). With one process, the trials run in this process.
+    :param rng: source of random numbers for the seeds of the trials
+    :param cancelled: if given, a function that is polled while the trials
+      run. Once it returns true, the workers are stopped, `factory` is left
+      unchanged and `None` is returned.
+
+    The other parameters are as for :py:func:`generate_songs`.
+
+    :raise ValueError: if the sum of frequencies is not positive
+    '''
+    if sum(freqs.values()) <= 0.0:
         raise ValueError('Must have at least one non-zero frequency')
-    for g in freqs.keys():
-        freqs[g] /= tfreq
-    seen = {g: 0 for g in freqs}
-
-    sequence = [factory.get_genres(x) for x in prefix]
-    prefix_len = len(sequence)
-    songs = []
-    current_duration = 0
-    while current_duration < duration and freqs:
-        g = next_genre(len(sequence), seen, freqs)
-        song = factory.get(g)
-        if song is None:
-            # Exhausted that genre
-            del freqs[g]
-            continue
-        seen[g] += 1
-
-        # g is a list from here on
-        g = factory.get_genres(song)
-        sequence.insert(prefix_len, g) # Insert right after the prefix
-        cur_score = 0   # Was score(sequence, repel), but only deltas matter
-        scores = [cur_score]
-        for i in range(prefix_len, len(sequence) - 1):
-            # Subtract old relative values
-            cur_score -= score_pair(sequence, repel, i)
-            # Swap new item along one
-            sequence[i], sequence[i + 1] = sequence[i + 1], sequence[i]
-            # Add new relative values
-            cur_score += score_pair(sequence, repel, i)
-            scores.append(cur_score)
-        sequence.pop() # Remove the temporarily added new genre
-
-        place = pick_smallest(enumerate(scores))
-        sequence.insert(place + prefix_len, g)
-        songs.insert(place, song)
-        current_duration += factory.get_duration(song)
-    return songs
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, trials))
+    deadline = time.time() + budget if budget is not None else None
+    seeds = [rng.getrandbits(32) for i in range(trials)]
+    genres, portable = factory.get_portable_state(list(freqs))
+    state = {
+        'freqs': [[i, freqs[g]] for (i, g) in enumerate(freqs)],
+        'repel': [[repel[(a, b)] for b in genres] for a in genres],
+        'duration': duration,
+        'prefix': list(prefix),
+        'backend': backend,
+        'factory': portable
+    }
+
+    results = {}
+    status = 'failed'
+    if processes > 1:
+        status = _run_trial_processes(state, seeds, processes, deadline, cancelled, results)
+        if status == 'cancelled':
+            return None
+    if status == 'failed':
+        _init_trial(state)
+        try:
+            for i, seed in enumerate(seeds):
+                if i in results:
+                    continue
+                if cancelled is not None and cancelled():
+                    return None
+                if results and deadline is not None and time.time() >= deadline:
+                    break
+                results[i] = _run_trial(seed)
+        finally:
+            _init_trial(None)
+
+    # Lowest score wins, with ties going to the earliest seed
+    best = min(sorted(results.items()), key = lambda item: item[1][0])[1]
+    factory.take(best[1], [genres[g] for g in best[2]])
+    return best[1]
+
+def stream_songs(freqs, repel, factory, prefix = [], horizon = 3600, backend = None,
+                 strategy = 'insert'):
+    '''
+    Generate songs without a fixed total duration, yielding them in order.
+    Since a new song may be inserted anywhere in the uncommitted part of the
+    list, a song is only yielded once at least `horizon` worth of music has
+    been generated after it. The iterator stops when every genre is
+    exhausted, so the caller should simply stop consuming it when it has
+    enough songs.
+
+    The cost per song and the memory use depend on `horizon`, but not on how
+    many songs have been yielded. Frequency targets are maintained across the
+    whole stream.
+
+    :param horizon: duration of uncommitted songs to keep ahead of the yielded
+      songs (same units as the factory's durations). It is ignored by
+      strategies that only append, since their songs are final at once.
+
+    The other parameters are as for :py:func:`generate_songs`.
+
+    :raise ValueError: if the sum of frequencies is not positive
+    '''
+    gen = strategies[strategy](freqs, repel, factory, prefix, backend)
+    if gen.append_only:
+        horizon = 0
+    return _stream(gen, horizon)
+
+def _stream(gen, horizon):
+    # Separate from stream_songs so that errors are raised on the call
+    while True:
+        while not gen.pending or gen.pending_duration < horizon:
+            if gen.step() is None:
+                for song in gen.commit():
+                    yield song
+                return
+        for song in gen.commit(1):
+            yield song
 
 class TrivialSong(object):
     '''
@@ -255,4 +2127,4 @@ if __name__ == '__main__':
         for g in songs:
             print(g.genre.name)
 
-__all__ = ['generate_songs']
+__all__ = ['generate_songs', 'generate_best', 'stream_songs', 'Generator', 'BeamGenerator', 'Stats', 'BlockedList', 'SlotSearch']
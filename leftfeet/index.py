@@ -0,0 +1,166 @@
+# LeftFeet: generates a Rhythmbox play queue for social dancing
+# Copyright (C) 2014  Bruce Merry <bmerry@users.sourceforge.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Persistent index of the songs in the library, so that generating a play queue
+does not need to walk the whole Rhythmbox library. The plugin feeds it the
+properties of each entry, and keeps it up to date as entries change;
+:py:mod:`batch` only reads it.
+
+The index stores the raw properties of each song, including its genre
+string, rather than whether it is a candidate. Classification and filtering
+(such as skipping songs played recently) happen when the index is read, so
+that they can depend on the time and on the site configuration.
+'''
+
+import sqlite3
+
+# Increment when the layout of the songs table changes
+SCHEMA_VERSION = 2
+
+COLUMNS = ('location', 'genre', 'duration', 'rating', 'last_played', 'bitrate', 'lossless',
+           'play_count')
+
+class LibraryIndex(object):
+    '''
+    An sqlite database with one row per song, keyed by location.
+
+    Rows are stamped with the generation in which they were last written.
+    A full resynchronisation (see :py:meth:`begin_sync`) starts a new
+    generation, and rows that it does not visit are removed at the end, so
+    that songs deleted while the index was not being updated do not linger.
+
+    :ivar str path: path to the database file
+    :ivar bool synced: whether a resynchronisation has ever finished. Until
+      then, the index may hold only part of the library.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._generation = self._check_schema()
+        self._syncing = False
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'synced'").fetchone()
+        self.synced = row is not None and bool(row[0])
+
+    def _check_schema(self):
+        '''
+        Create the tables if necessary, discarding songs indexed with an
+        older layout, and return the current generation.
+        '''
+        conn = self._conn
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+        row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != SCHEMA_VERSION:
+            conn.execute('DROP TABLE IF EXISTS songs')
+            conn.execute('CREATE TABLE songs (location TEXT PRIMARY KEY, genre TEXT, '
+                         'duration INTEGER, rating REAL, last_played INTEGER, '
+                         'bitrate INTEGER, lossless INTEGER, play_count INTEGER, '
+                         'generation INTEGER)')
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (SCHEMA_VERSION,))
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('generation', 0)")
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('synced', 0)")
+            conn.commit()
+        return conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM songs').fetchone()[0]
+
+    def update(self, rows):
+        '''
+        Add or replace songs. Changes are not saved until :py:meth:`commit`.
+
+        :param rows: iterable of tuples of properties, in the order given by
+          :py:data:`COLUMNS`
+        '''
+        generation = self._generation
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (tuple(row) + (generation,) for row in rows))
+
+    def remove(self, location):
+        '''
+        Remove a song, if it is present. Changes are not saved until
+        :py:meth:`commit`.
+        '''
+        self._conn.execute('DELETE FROM songs WHERE location = ?', (location,))
+
+    def commit(self):
+        self._conn.commit()
+
+    def begin_sync(self):
+        '''
+        Start a full resynchronisation. The caller should pass every song in
+        the library to :py:meth:`update`, and then call :py:meth:`end_sync`.
+        Songs may still be updated and removed individually in between.
+        '''
+        self._generation += 1
+        self._syncing = True
+        self._conn.execute("UPDATE meta SET value = ? WHERE key = 'generation'", (self._generation,))
+
+    def end_sync(self):
+        '''
+        Finish a resynchronisation, removing the songs it did not visit, and
+        record that the index is complete.
+        '''
+        if self._syncing:
+            self._conn.execute('DELETE FROM songs WHERE generation < ?', (self._generation,))
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('synced', 1)")
+            self._conn.commit()
+            self._syncing = False
+            self.synced = True
+
+    def load(self, snapshot, classify, valid, now, exclude = ()):
+        '''
+        Add the songs that are candidates for generation to a snapshot.
+        Each distinct genre string is classified only once.
+
+        :param snapshot: snapshot to add to. The entry recorded for each song
+          is its location.
+        :type snapshot: :py:class:`library.Snapshot`
+        :param classify: function mapping a genre string to a list of genres
+          (see :py:func:`lf_site.classify`)
+        :param valid: function deciding whether a song may be chosen (see
+          :py:func:`lf_site.valid_song`)
+        :param now: current time, passed to `valid`
+        :param exclude: locations of songs to leave out
+        :return: indices of the added songs in `snapshot`
+        '''
+        classified = {}
+        for (genre,) in self._conn.execute('SELECT DISTINCT genre FROM songs'):
+            genres = classify(genre or '')
+            if genres:
+                classified[genre] = genres
+        candidates = []
+        for row in self._conn.execute('SELECT {} FROM songs'.format(', '.join(COLUMNS))):
+            location, genre, duration, rating, last_played, bitrate, lossless, play_count = row
+            genres = classified.get(genre)
+            if genres is None or location in exclude:
+                continue
+            lossless = bool(lossless)
+            if valid(rating, last_played, bitrate, lossless, now):
+                candidates.append(snapshot.add(location, duration, rating, last_played,
+                                               bitrate, lossless, genres, play_count))
+        return candidates
+
+    def close(self):
+        '''
+        Save changes and close the database. An unfinished resynchronisation
+        is abandoned, without removing anything.
+        '''
+        self._conn.commit()
+        self._conn.close()
+
+__all__ = ['LibraryIndex', 'COLUMNS', 'SCHEMA_VERSION']
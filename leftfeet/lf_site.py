@@ -36,13 +36,26 @@ Contains site-local configuration of the available genres.
   A dictionary indexed by pairs of genres (for all pairs), with
   values being penalty scores for putting the genres close together
 
+.. data:: config
+
+  The :py:class:`siteconfig.SiteConfig` that the above are taken from. The
+  genres, aliases and penalty scores are defined in ``lf_site.json``, which
+  is looked for first in the user data directory, then next to this file
+  and finally next to :py:mod:`siteconfig`, so that a copy of this file in
+  the user data directory can still use the bundled data.
+
 .. todo:: Resolve the following questions
 
   - Should Viennese Waltz be classed as open?
   - Should Samba and Salsa be classed as similar?
-  - Should there be any weighting of random choices by star rating?
   - What settings should be presented in the plugin? Should they pop up on use or just be plugin settings?
 '''
+import os
+try:
+    from . import siteconfig
+except (ImportError, ValueError):
+    import siteconfig
+
 MIN_STARS = 2
 MIN_BITRATE = 128
 
@@ -55,95 +68,88 @@ BALLROOM = 0
 LATIN = 1
 OTHER = 2
 
-class Genre(object):
-    '''
-    Encapsulates a genre that the generator may produce.
+Genre = siteconfig.Genre
+
+# The genres themselves are in lf_site.json, which may also be overridden by
+# putting a copy in the user data directory. A copy of this file in the user
+# data directory still finds the bundled one beside siteconfig.
+_user_dir = siteconfig.user_data_dir()
+_search = [_user_dir, os.path.dirname(os.path.abspath(__file__)),
+           os.path.dirname(os.path.abspath(siteconfig.__file__))]
+_source = siteconfig.find('lf_site.json', _search)
+if _source is None:
+    raise IOError('lf_site.json not found in any of {}'.format(', '.join(_search)))
+config = siteconfig.load(_source, os.path.join(_user_dir, siteconfig.CACHE_NAME))
+
+genres = config.genres
+genres_by_name = config.genres_by_name
+genre_aliases = config.aliases
+repel = config.repel
+
+def valid_song(rating, last_played, bitrate, lossless, now):
     '''
-    def __init__(self, name, level, group, energy = 0):
-        self.name = name
-        self.level = level
-        self.group = group
-        self.energy = energy
-        self.default_freq = 20.0
-
-    def __str__(self):
-        return self.name
-
-genres = [
-    Genre('foxtrot', BEGINNER, BALLROOM),
-    Genre('waltz', BEGINNER, BALLROOM),
-    Genre('quickstep', INTERMEDIATE, BALLROOM, 1),
-    Genre('tango, international', ADVANCED, BALLROOM),
-    Genre('cha-cha', BEGINNER, LATIN),
-    Genre('jive', BEGINNER, LATIN, 1),
-    Genre('rumba', INTERMEDIATE, LATIN),
-    Genre('samba', ADVANCED, LATIN),
-    Genre('boogie', OPEN, OTHER),
-    Genre('sokkie', OPEN, OTHER, 1),
-    Genre('salsa', OPEN, LATIN),
-    Genre('viennese waltz', OPEN, BALLROOM, 1)
-]
-
-genres_by_name = {g.name: g for g in genres}
-
-genre_aliases = {
-    'boogie, cha-cha': ['boogie', 'cha-cha'],
-    'boogie, salsa?': ['boogie', 'salsa'],
-    'boogie, sokkie': ['boogie', 'sokkie'],
-    'foxtrot, slow': ['foxtrot'],
-    'jive, slow': ['jive'],
-    'quickstep, boogie': ['quickstep', 'boogie'],
-    'quickstep, tango': ['quickstep', 'tango'],
-    'rumba': ['rumba'],
-    'viennese': ['viennese waltz'],
-    'waltz, viennese': ['viennese waltz']
-}
-
-repel = {}
-
-for i in genres:
-    for j in genres:
-        rep = 0
-        if i == j:
-            # Really don't want two of the same genre in a row
-            rep += 20
-        elif i.name.endswith(j.name) or j.name.endswith(i.name):
-            # Tangos and Waltzes are also similar
-            rep += 10
-
-        # Avoid too many exhausting dances together
-        rep += i.energy * j.energy
-        # Avoid clumping all the advanced dances or all dances of one type together
-        rep += 5 - abs(i.level - j.level)
-        if i.group == j.group:
-            rep += 1
-        repel[(i, j)] = rep
+    Determine whether a song should be considered, given its properties.
 
-def valid_entry(entry, now):
-    '''
-    Determine whether this song should be considered.
-    :param `RB.RhythmDB.Entry` entry: song to test
+    :param float rating: star rating
+    :param int last_played: time last played (seconds since the epoch)
+    :param int bitrate: bitrate in kbps (ignored if `lossless` is true)
+    :param bool lossless: whether the song is losslessly encoded
     :param now: cached value of :py:func`time.time()`
     :rtype: boolean
     '''
-    from gi.repository import RB
-
     # Filtering
-    rating = entry.get_double(RB.RhythmDBPropType.RATING)
     if rating < MIN_STARS:
         return False
 
-    last_played = entry.get_ulong(RB.RhythmDBPropType.LAST_PLAYED)
     if last_played > now - 43200:   # Last 12 hours
         return False
 
-    if not entry.is_lossless():
-        quality = entry.get_ulong(RB.RhythmDBPropType.BITRATE)
-        if quality is None or quality < MIN_BITRATE:
+    if not lossless:
+        if bitrate is None or bitrate < MIN_BITRATE:
             return False
 
     return True
 
+def song_weight(rating, play_count, last_played, now):
+    '''
+    Determine how likely a song that passes :py:func:`valid_song` is to be
+    chosen, relative to the other songs of the same genre. Return the same
+    positive number for every song to choose uniformly.
+
+    :param float rating: star rating
+    :param int play_count: number of times played
+    :param int last_played: time last played (seconds since the epoch)
+    :param now: cached value of :py:func`time.time()`
+    :rtype: float
+    '''
+    return config.song_weight(rating, play_count, last_played, now)
+
+def valid_entry(entry, now):
+    '''
+    Determine whether this song should be considered.
+    :param `RB.RhythmDB.Entry` entry: song to test
+    :param now: cached value of :py:func`time.time()`
+    :rtype: boolean
+    '''
+    from gi.repository import RB
+
+    return valid_song(
+        entry.get_double(RB.RhythmDBPropType.RATING),
+        entry.get_ulong(RB.RhythmDBPropType.LAST_PLAYED),
+        entry.get_ulong(RB.RhythmDBPropType.BITRATE),
+        entry.is_lossless(),
+        now)
+
+def classify(name):
+    '''
+    Map the genre string of a song to its genres.
+
+    :param str name: genre string, as stored in the library
+    :returns: The matching genres
+    :rtype: list of :py:class:`Genre`
+    '''
+    return config.classify(name)
+
 def get_genres(entry):
     '''
     Map an entry to its genres.
@@ -154,11 +160,6 @@ def get_genres(entry):
     '''
     from gi.repository import RB
 
-    name = entry.get_string(RB.RhythmDBPropType.GENRE).lower()
-    if name in genre_aliases:
-        names = genre_aliases[name]
-    else:
-        names = [name]
-    return [genres_by_name[x] for x in names if x in genres_by_name]
+    return classify(entry.get_string(RB.RhythmDBPropType.GENRE))
 
-__all__ = ['genres', 'repel', 'get_genres', 'valid_entry']
+__all__ = ['genres', 'repel', 'config', 'get_genres', 'valid_entry', 'classify', 'valid_song', 'song_weight']
@@ -0,0 +1,540 @@
+# LeftFeet: generates a Rhythmbox play queue for social dancing
+# Copyright (C) 2014  Bruce Merry <bmerry@users.sourceforge.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Data structures for holding the songs that are available to the generator: a
+:py:class:`Snapshot` of their properties, pools that draw them by genre
+without replacement, and the :py:class:`Factory` that puts the two together.
+'''
+
+import random
+
+def _distinct(genres):
+    '''
+    Return `genres` without repeats, keeping the first of each, so that a
+    song listed twice under a genre is only added to (and removed from) it
+    once.
+    '''
+    distinct = []
+    for g in genres:
+        if g not in distinct:
+            distinct.append(g)
+    return tuple(distinct)
+
+class SongPool(object):
+    '''
+    The songs available in each genre, supporting random draws without
+    replacement. Each genre has an array of songs, and removal swaps the last
+    song into the hole. Every song records its slot in the array for each of
+    its genres, so a song with several genres is removed from all of them in
+    constant time.
+
+    Removals are journalled, so that they can be undone with
+    :py:meth:`rollback`. Undoing a removal restores the exact order of the
+    arrays, so a rolled-back pool makes the same draws as before.
+
+    Songs may be any hashable objects.
+
+    :ivar dict songs: array of available songs for each genre
+    :ivar dict slots: for each genre, maps each available song to its index in `songs`
+    :ivar dict genres: genres for each song that has been added
+    '''
+    def __init__(self, genres = ()):
+        self.songs = {g: [] for g in genres}
+        self.slots = {g: {} for g in genres}
+        self.genres = {}
+        self._journal = []
+
+    def add(self, song, genres):
+        '''
+        Make a song available in each of the given genres.
+        '''
+        genres = _distinct(genres)
+        self.genres[song] = genres
+        for g in genres:
+            songs = self.songs.setdefault(g, [])
+            self.slots.setdefault(g, {})[song] = len(songs)
+            songs.append(song)
+
+    def count(self, genre):
+        '''
+        Number of songs still available in `genre`.
+        '''
+        return len(self.songs.get(genre, ()))
+
+    def __contains__(self, song):
+        genres = self.genres.get(song)
+        return bool(genres) and song in self.slots[genres[0]]
+
+    def draw(self, genre, rng = random):
+        '''
+        Remove and return a random song from `genre`, or `None` if there are
+        none left.
+
+        :param rng: source of random numbers
+        '''
+        songs = self.songs.get(genre)
+        if not songs:
+            return None
+        song = rng.choice(songs)
+        self.remove(song)
+        return song
+
+    def remove(self, song):
+        '''
+        Remove a song from every genre it belongs to.
+        '''
+        removed = []
+        for g in self.genres[song]:
+            songs = self.songs[g]
+            slots = self.slots[g]
+            pos = slots.pop(song)
+            last = songs.pop()
+            if pos < len(songs):
+                songs[pos] = last
+                slots[last] = pos
+            removed.append((g, pos))
+        self._journal.append((song, removed))
+
+    def mark(self):
+        '''
+        Return a token for the current state, to pass to :py:meth:`rollback`.
+        '''
+        return len(self._journal)
+
+    def rollback(self, mark):
+        '''
+        Return all songs removed since :py:meth:`mark` returned `mark`.
+        '''
+        while len(self._journal) > mark:
+            song, removed = self._journal.pop()
+            for g, pos in reversed(removed):
+                songs = self.songs[g]
+                slots = self.slots[g]
+                if pos < len(songs):
+                    moved = songs[pos]
+                    slots[moved] = len(songs)
+                    songs.append(moved)
+                    songs[pos] = song
+                else:
+                    songs.append(song)
+                slots[song] = pos
+
+    def commit(self):
+        '''
+        Discard the journal, making the removals so far permanent.
+        '''
+        del self._journal[:]
+
+    def get_state(self, index):
+        '''
+        Return the available songs as a list of `[genre, songs]` pairs, with
+        each genre replaced by `index[genre]`.
+        '''
+        return [[index[g], list(songs)] for (g, songs) in self.songs.items()]
+
+    def set_state(self, state, genres, get_genres):
+        '''
+        Replace the contents with a state returned by :py:meth:`get_state`.
+
+        :param list genres: the genres, indexed as in `state`
+        :param get_genres: function returning the genres of a song
+        '''
+        self.__init__()
+        for g, songs in state:
+            g = genres[g]
+            self.songs[g] = list(songs)
+            self.slots[g] = {song: i for (i, song) in enumerate(songs)}
+            for song in songs:
+                self.genres[song] = _distinct(get_genres(song))
+
+class FenwickTree(object):
+    '''
+    Binary indexed tree over a list of non-negative integers, supporting
+    changes to single values, and finding the position at which the running
+    sum passes a given value, in O(log n).
+
+    :ivar total: sum of the values
+    '''
+    def __init__(self):
+        self._tree = [0]
+        self.total = 0
+
+    def __len__(self):
+        return len(self._tree) - 1
+
+    def append(self, value):
+        tree = self._tree
+        i = len(tree)
+        # Node i covers the values after i - (i & -i), up to and including i
+        low = i - (i & -i)
+        covered = value
+        j = i - 1
+        while j > low:
+            covered += tree[j]
+            j -= j & -j
+        tree.append(covered)
+        self.total += value
+
+    def add(self, pos, delta):
+        '''
+        Add `delta` to the value at `pos`.
+        '''
+        tree = self._tree
+        i = pos + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+        self.total += delta
+
+    def find(self, x):
+        '''
+        Return the smallest position whose running sum (inclusive) exceeds
+        `x`, for `0 <= x < total`.
+        '''
+        tree = self._tree
+        n = len(tree) - 1
+        pos = 0
+        step = 1
+        while step * 2 <= n:
+            step *= 2
+        while step:
+            nxt = pos + step
+            if nxt <= n and tree[nxt] <= x:
+                pos = nxt
+                x -= tree[nxt]
+            step //= 2
+        return pos
+
+class WeightedSongPool(object):
+    '''
+    Variant of :py:class:`SongPool` in which each song is drawn with
+    probability proportional to its weight. Each genre has an array of songs
+    and a :py:class:`FenwickTree` over their weights. A removed song keeps
+    its place in the array, with its weight set to zero, so that a draw
+    and a removal each cost O(log n) per genre of the song.
+
+    Weights are rounded to a multiple of 1 / :py:attr:`scale` (and at least
+    that), so that the sums are exact integers.
+
+    :ivar dict genres: genres for each song that has been added
+    :ivar dict weights: rounded weight of each song that has been added
+    '''
+    scale = 1000
+
+    def __init__(self, genres = ()):
+        self.genres = {}
+        self.weights = {}
+        self._songs = {g: [] for g in genres}
+        self._trees = {g: FenwickTree() for g in genres}
+        self._slots = {g: {} for g in genres}
+        self._counts = {g: 0 for g in genres}
+        self._available = set()
+        self._journal = []
+
+    def add(self, song, genres, weight = 1.0):
+        '''
+        Make a song available in each of the given genres.
+        '''
+        weight = max(1, int(round(weight * self.scale)))
+        genres = _distinct(genres)
+        self.genres[song] = genres
+        self.weights[song] = weight
+        self._available.add(song)
+        for g in genres:
+            songs = self._songs.setdefault(g, [])
+            self._slots.setdefault(g, {})[song] = len(songs)
+            songs.append(song)
+            self._trees.setdefault(g, FenwickTree()).append(weight)
+            self._counts[g] = self._counts.get(g, 0) + 1
+
+    def count(self, genre):
+        return self._counts.get(genre, 0)
+
+    def __contains__(self, song):
+        return song in self._available
+
+    def draw(self, genre, rng = random):
+        '''
+        Remove and return a song from `genre`, chosen with probability
+        proportional to its weight, or `None` if there are none left.
+        '''
+        if not self._counts.get(genre):
+            return None
+        tree = self._trees[genre]
+        song = self._songs[genre][tree.find(rng.randrange(tree.total))]
+        self.remove(song)
+        return song
+
+    def _update(self, song, sign):
+        delta = sign * self.weights[song]
+        for g in self.genres[song]:
+            self._trees[g].add(self._slots[g][song], delta)
+            self._counts[g] += sign
+
+    def remove(self, song):
+        '''
+        Remove a song from every genre it belongs to.
+        '''
+        self._update(song, -1)
+        self._available.remove(song)
+        self._journal.append(song)
+
+    def mark(self):
+        return len(self._journal)
+
+    def rollback(self, mark):
+        while len(self._journal) > mark:
+            song = self._journal.pop()
+            self._update(song, 1)
+            self._available.add(song)
+
+    def commit(self):
+        del self._journal[:]
+
+    def get_state(self, index):
+        '''
+        Return the available songs as a list of `[genre, songs, weights]`,
+        with each genre replaced by `index[genre]`. Songs keep their
+        relative order, so a restored pool makes the same draws.
+        '''
+        state = []
+        for g, songs in self._songs.items():
+            available = [song for song in songs if song in self._available]
+            state.append([index[g], available, [self.weights[song] for song in available]])
+        return state
+
+    def set_state(self, state, genres, get_genres):
+        '''
+        Replace the contents with a state returned by :py:meth:`get_state`.
+        '''
+        self.__init__()
+        for g, songs, weights in state:
+            g = genres[g]
+            self._songs[g] = list(songs)
+            self._slots[g] = {song: i for (i, song) in enumerate(songs)}
+            self._counts[g] = len(songs)
+            tree = self._trees[g] = FenwickTree()
+            for song, weight in zip(songs, weights):
+                tree.append(weight)
+                self.weights[song] = weight
+                self.genres[song] = _distinct(get_genres(song))
+                self._available.add(song)
+
+class Snapshot(object):
+    '''
+    A copy of the properties of library entries that LeftFeet uses, stored as
+    parallel arrays so that they only need to be read from Rhythmbox once.
+    Songs are referred to by their index into the arrays. Lists of genres are
+    interned, so that songs with the same genres share one tuple.
+
+    :ivar list entries: the original entry for each song
+    :ivar list durations: duration of each song, in seconds
+    :ivar list ratings: star rating of each song
+    :ivar list last_played: time each song was last played (seconds since the epoch)
+    :ivar list play_counts: number of times each song has been played
+    :ivar list bitrates: bitrate of each song (kbps)
+    :ivar list lossless: whether each song is losslessly encoded
+    :ivar list genre_ids: index into `genre_sets` for each song
+    :ivar list genre_sets: each distinct tuple of genres
+    '''
+    def __init__(self):
+        self.entries = []
+        self.durations = []
+        self.ratings = []
+        self.last_played = []
+        self.play_counts = []
+        self.bitrates = []
+        self.lossless = []
+        self.genre_ids = []
+        self.genre_sets = []
+        self._genre_set_ids = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry, duration, rating, last_played, bitrate, lossless, genres, play_count = 0):
+        '''
+        Append a song, returning its index.
+        '''
+        key = tuple(genres)
+        genre_id = self._genre_set_ids.get(key)
+        if genre_id is None:
+            genre_id = len(self.genre_sets)
+            self.genre_sets.append(key)
+            self._genre_set_ids[key] = genre_id
+        self.entries.append(entry)
+        self.durations.append(duration)
+        self.ratings.append(rating)
+        self.last_played.append(last_played)
+        self.play_counts.append(play_count)
+        self.bitrates.append(bitrate)
+        self.lossless.append(lossless)
+        self.genre_ids.append(genre_id)
+        return len(self.entries) - 1
+
+    def genres(self, index):
+        '''
+        Return the tuple of genres for a song.
+        '''
+        return self.genre_sets[self.genre_ids[index]]
+
+    def __getstate__(self):
+        # Entries belong to the process that created the snapshot (and
+        # Rhythmbox entries cannot be pickled), so other processes only see
+        # the properties.
+        state = dict(self.__dict__)
+        state['entries'] = [None] * len(self.entries)
+        return state
+
+class Factory(object):
+    '''
+    Implementation of the factory concept for
+    :py:func:`generator.generate_songs` that draws songs from a
+    :py:class:`Snapshot`. Songs are indices into the snapshot.
+
+    :ivar snapshot: the songs
+    :vartype snapshot: :py:class:`Snapshot`
+    :ivar pool: songs that are still available for each genre
+    :vartype pool: :py:class:`SongPool` or :py:class:`WeightedSongPool`
+    :ivar list missing: genres we were asked for but could not provide
+    :ivar rng: source of random numbers for choosing songs
+    '''
+    def __init__(self, snapshot, candidates = None, rng = random, weight = None):
+        '''
+        :param snapshot: the songs
+        :param candidates: indices of the songs that may be chosen (defaults to all)
+        :param rng: source of random numbers (see :py:class:`generator.Generator`)
+        :param weight: if given, a function mapping the index of a song to a
+          positive weight, and songs are drawn with probability
+          proportional to their weights. Otherwise all songs are equally likely.
+        '''
+        if candidates is None:
+            candidates = range(len(snapshot))
+        self.snapshot = snapshot
+        self.missing = []
+        self.rng = rng
+        if weight is None:
+            self.pool = SongPool()
+            for index in candidates:
+                self.pool.add(index, snapshot.genres(index))
+        else:
+            self.pool = WeightedSongPool()
+            for index in candidates:
+                self.pool.add(index, snapshot.genres(index), weight(index))
+
+    def get(self, genre):
+        index = self.pool.draw(genre, self.rng)
+        if index is None:
+            self.missing.append(genre)
+        return index
+
+    def get_duration(self, index):
+        return self.snapshot.durations[index]
+
+    def get_genres(self, index):
+        return self.snapshot.genres(index)
+
+    def mark(self):
+        '''
+        Return a token for the current state, to pass to :py:meth:`rollback`.
+        '''
+        return (self.pool.mark(), len(self.missing))
+
+    def rollback(self, mark):
+        '''
+        Undo all calls to :py:meth:`get` since :py:meth:`mark` returned `mark`.
+        '''
+        self.pool.rollback(mark[0])
+        del self.missing[mark[1]:]
+
+    def take(self, songs, missing = ()):
+        '''
+        Remove songs from the pool and record missing genres, as if they had
+        been returned by :py:meth:`get`. This is used to adopt the outcome of a
+        generation that ran on a copy of the factory.
+        '''
+        for index in songs:
+            self.pool.remove(index)
+        self.missing.extend(missing)
+
+    def get_state(self, genres):
+        '''
+        Return the songs still available for each genre (and their weights,
+        if any), and the missing genres, as lists of numbers. Genres are
+        saved as indices into `genres`. Removals that have not been committed
+        are included as if they had been.
+        '''
+        index = {g: i for (i, g) in enumerate(genres)}
+        return {
+            'weighted': isinstance(self.pool, WeightedSongPool),
+            'pool': self.pool.get_state(index),
+            'missing': [index[g] for g in self.missing]
+        }
+
+    def set_state(self, state, genres):
+        '''
+        Return to a state saved by :py:meth:`get_state`, which must have been
+        taken from a factory on the same snapshot.
+        '''
+        self.pool = WeightedSongPool() if state['weighted'] else SongPool()
+        self.pool.set_state(state['pool'], genres, self.snapshot.genres)
+        self.missing = [genres[g] for g in state['missing']]
+
+    def get_portable_state(self, genres = ()):
+        '''
+        Return what another process needs to recreate this factory with
+        :py:meth:`from_portable_state`, made up only of lists and numbers.
+        Unlike :py:meth:`get_state`, it includes the durations and genres of
+        the songs in the snapshot, so that the other process does not need
+        the snapshot, the genre objects or any Rhythmbox object.
+
+        :param genres: genres to number first. Any other genres of the songs,
+          and missing genres, are numbered after them.
+        :return: tuple of the list of genres, by number, and the state
+        '''
+        genres = list(genres)
+        index = {g: i for (i, g) in enumerate(genres)}
+        for key in self.snapshot.genre_sets + [tuple(self.missing)]:
+            for g in key:
+                if g not in index:
+                    index[g] = len(genres)
+                    genres.append(g)
+        return genres, {
+            'genres': len(genres),
+            'durations': list(self.snapshot.durations),
+            'genre_ids': list(self.snapshot.genre_ids),
+            'genre_sets': [[index[g] for g in key] for key in self.snapshot.genre_sets],
+            'factory': self.get_state(genres)
+        }
+
+    @classmethod
+    def from_portable_state(cls, state, rng = random):
+        '''
+        Recreate a factory from :py:meth:`get_portable_state`. Songs are the
+        same indices as in the original, but genres are replaced by their
+        numbers and entries by `None`.
+        '''
+        snapshot = Snapshot()
+        snapshot.durations = state['durations']
+        snapshot.genre_ids = state['genre_ids']
+        snapshot.genre_sets = [tuple(key) for key in state['genre_sets']]
+        snapshot.entries = [None] * len(snapshot.durations)
+        self = cls(snapshot, (), rng)
+        self.set_state(state['factory'], list(range(state['genres'])))
+        return self
+
+__all__ = ['SongPool', 'FenwickTree', 'WeightedSongPool', 'Snapshot', 'Factory']
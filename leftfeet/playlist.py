@@ -0,0 +1,98 @@
+# LeftFeet: generates a Rhythmbox play queue for social dancing
+# Copyright (C) 2014  Bruce Merry <bmerry@users.sourceforge.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Writes lists of songs as playlist files that other players (and Rhythmbox
+itself) can import.
+
+Each track is given as a tuple of its location (a URI, as Rhythmbox stores
+it), its duration in seconds, and its title, which may be `None`.
+'''
+
+from __future__ import unicode_literals
+
+import io
+import os
+import xml.etree.ElementTree as ET
+try:
+    from urllib.parse import urlparse, unquote
+except ImportError:
+    from urlparse import urlparse   # Python 2
+    from urllib import unquote
+
+FORMATS = ('m3u', 'xspf')
+
+def local_path(location):
+    '''
+    Convert a `file://` URI to a path, leaving other locations unchanged.
+    '''
+    parts = urlparse(location)
+    if parts.scheme == 'file':
+        return unquote(parts.path)
+    return location
+
+def _title(location, title):
+    if title:
+        return title
+    return os.path.splitext(os.path.basename(local_path(location)))[0]
+
+def write_m3u(path, tracks, title = None):
+    '''
+    Write an extended M3U playlist. Local files are written as paths, and
+    anything else as a URI.
+
+    :param title: ignored, as M3U has no playlist title
+    '''
+    with io.open(path, 'w', encoding = 'utf-8') as f:
+        f.write('#EXTM3U\n')
+        for location, duration, name in tracks:
+            f.write('#EXTINF:{},{}\n'.format(int(duration), _title(location, name)))
+            f.write(local_path(location) + '\n')
+
+def write_xspf(path, tracks, title = None):
+    '''
+    Write an XSPF playlist.
+
+    :param str title: title of the playlist
+    '''
+    root = ET.Element('playlist', {'version': '1', 'xmlns': 'http://xspf.org/ns/0/'})
+    if title is not None:
+        ET.SubElement(root, 'title').text = title
+    track_list = ET.SubElement(root, 'trackList')
+    for location, duration, name in tracks:
+        track = ET.SubElement(track_list, 'track')
+        ET.SubElement(track, 'location').text = location
+        if name:
+            ET.SubElement(track, 'title').text = name
+        ET.SubElement(track, 'duration').text = str(int(duration * 1000))
+    ET.ElementTree(root).write(path, encoding = 'utf-8', xml_declaration = True)
+
+def write(path, tracks, format = None, title = None):
+    '''
+    Write a playlist in one of :py:data:`FORMATS`. If `format` is not
+    given, it is taken from the extension of `path`.
+    '''
+    if format is None:
+        format = os.path.splitext(path)[1][1:].lower()
+    if format == 'm3u':
+        write_m3u(path, tracks, title)
+    elif format == 'xspf':
+        write_xspf(path, tracks, title)
+    else:
+        raise ValueError('Unknown playlist format {!r}'.format(format))
+
+__all__ = ['FORMATS', 'local_path', 'write_m3u', 'write_xspf', 'write']
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+
+# LeftFeet: generates a Rhythmbox play queue for social dancing
+# Copyright (C) 2014  Bruce Merry <bmerry@users.sourceforge.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function
+
+'''
+Records the decisions made while generating a list, so that the generation
+can be run again later, without Rhythmbox or the library, to check that it
+behaves the same or to profile it:
+
+    python replay.py trace.jsonl [--profile]
+
+A trace is written by :py:class:`TraceRecorder`, which is passed as the
+`trace` of :py:func:`generator.generate_songs` or of a generator. The plugin
+writes one for each generation if ``LEFTFEET_TRACE`` is set in the
+environment to the name of the file, and :py:mod:`generate` writes one with
+``--trace``.
+
+The trace is a text file with one JSON value per line. The first line is an
+object holding everything the generator was given: the seed of its random
+number generator, the strategy, backend, window and slot search (see
+:py:class:`generator.SlotSearch`), the genres (by name) and
+the repulsion between each pair of them, the frequencies and the genres of
+each song in the prefix. Genres are given as indices into the list of
+genres. Each following line is a list recording one event:
+
+- ``["g", genre, genres, duration, slot]``: the factory was asked for a song
+  of `genre`, and returned one with the given genres and duration, which was
+  placed at position `slot` among the uncommitted songs. If the genre was
+  exhausted, the last three are ``null``.
+- ``["c", count]``: `count` songs were committed.
+- ``["r", order]``: the uncommitted songs were refined, and put in the
+  given order (see :py:meth:`generator.Generator.reorder`), or left alone if
+  `order` is ``null``.
+
+Refinement has a time limit, so it is not repeated on replay: its result is
+applied instead. Songs are drawn by the factory with its own random numbers,
+which are not recorded, so the generator needs a random number generator of
+its own while tracing.
+'''
+
+import argparse
+import collections
+import json
+import random
+import sys
+import time
+
+try:
+    from . import generator
+except (ImportError, ValueError):
+    import generator
+
+TRACE_VERSION = 1
+
+class TraceRecorder(object):
+    '''
+    Writes a trace. The header is written straight away, so the generator
+    must be created with :py:attr:`rng` as its random number generator.
+
+    :param f: file opened for writing text
+    :param list genres: every genre that may be seen. Only these are
+      recorded in the repulsion table.
+    :param repel: repulsion between pairs of genres
+    :param dict freqs: frequencies given to the generator
+    :param factory: factory given to the generator, from which the genres and
+      durations of songs are looked up
+    :param prefix: songs already in the play queue
+    :param int seed: seed for :py:attr:`rng`. If not given, one is chosen at
+      random.
+    :param str strategy: strategy given to the generator
+    :param str backend: backend given to the generator
+    :param search: slot search given to the generator
+    :type search: :py:class:`generator.SlotSearch`
+    :param duration: duration requested, for information
+
+    :ivar rng: random number generator for the generator to use
+    :vartype rng: :py:class:`random.Random`
+    :raise ValueError: if `search` has a time budget, since the number of
+      candidates then depends on timing
+    '''
+    def __init__(self, f, genres, repel, freqs, factory, prefix = (), seed = None,
+                 strategy = 'insert', backend = None, search = None, duration = None):
+        if search is not None and (search.per_song is not None or search.total is not None):
+            raise ValueError('A slot search with a time budget cannot be replayed')
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.rng = random.Random(seed)
+        self._file = f
+        self._factory = factory
+        self._index = {g: i for (i, g) in enumerate(genres)}
+        header = {
+            'version': TRACE_VERSION,
+            'seed': seed,
+            'strategy': strategy,
+            'backend': backend or generator.default_backend,
+            'window': generator.WINDOW,
+            'search': [search.mode, search.count] if search is not None else None,
+            'duration': duration,
+            'genres': [getattr(g, 'name', str(g)) for g in genres],
+            'repel': [[repel[(a, b)] for b in genres] for a in genres],
+            # In the order given, since the generator breaks ties by it
+            'freqs': [[self._index[g], f] for (g, f) in freqs.items()],
+            'prefix': [self._genres(song) for song in prefix]
+        }
+        self._write(header)
+
+    def _genres(self, song):
+        return [self._index[g] for g in self._factory.get_genres(song)]
+
+    def _write(self, value):
+        self._file.write(json.dumps(value, separators = (',', ':')) + '\n')
+
+    def choice(self, genre, song, slot):
+        '''
+        Record a call to the factory's `get`, and where the song was put.
+        '''
+        if song is None:
+            self._write(['g', self._index[genre], None, None, None])
+        else:
+            self._write(['g', self._index[genre], self._genres(song),
+                         self._factory.get_duration(song), slot])
+
+    def commit(self, count):
+        self._write(['c', count])
+        # Keep what has been recorded so far if the process dies
+        self._file.flush()
+
+    def refine(self, order):
+        self._write(['r', order])
+
+    def close(self):
+        self._file.close()
+
+class Replay(object):
+    '''
+    Stands in for both the factory and the trace of a generator, so that
+    it repeats a recorded generation. Songs are returned in the order
+    recorded, and each decision is checked against the record.
+
+    Genres are replaced by their indices, and songs by integers: the songs
+    in the prefix are negative, and the others count up from 0.
+
+    :param header: first line of the trace
+    :param events: the other lines of the trace
+
+    :ivar freqs: frequencies, in the recorded order
+    :ivar dict repel: repulsion between pairs of genre indices
+    :ivar list prefix: songs in the prefix
+    :ivar int decisions: number of events replayed so far
+    '''
+    def __init__(self, header, events):
+        if header.get('version') != TRACE_VERSION:
+            raise ValueError('Unsupported trace version {!r}'.format(header.get('version')))
+        self.header = header
+        self.events = events
+        self.decisions = 0
+        self.freqs = collections.OrderedDict((g, f) for (g, f) in header['freqs'])
+        self.repel = {}
+        for a, row in enumerate(header['repel']):
+            for b, value in enumerate(row):
+                self.repel[(a, b)] = value
+        self._genres = {}
+        self._durations = {}
+        self.prefix = []
+        for i, genres in enumerate(header['prefix']):
+            song = -1 - i
+            self._genres[song] = genres
+            self._durations[song] = 0
+            self.prefix.append(song)
+        self._next_song = 0
+
+    def _fail(self, message):
+        raise ValueError('Event {}: {}'.format(self.decisions + 1, message))
+
+    def _expect(self, kind):
+        if self.decisions >= len(self.events):
+            self._fail('the trace has ended, but the generator continued')
+        event = self.events[self.decisions]
+        if event[0] != kind:
+            self._fail('expected {!r} in the trace but the generator did {!r}'.format(event[0], kind))
+        return event
+
+    def _done(self):
+        self.decisions += 1
+
+    # Factory interface
+
+    def get(self, genre):
+        event = self._expect('g')
+        if event[1] != genre:
+            self._fail('asked for genre {} rather than {}'.format(
+                self.header['genres'][genre], self.header['genres'][event[1]]))
+        if event[2] is None:
+            return None
+        song = self._next_song
+        self._next_song += 1
+        self._genres[song] = event[2]
+        self._durations[song] = event[3]
+        return song
+
+    def get_genres(self, song):
+        return self._genres[song]
+
+    def get_duration(self, song):
+        return self._durations[song]
+
+    # Trace interface
+
+    def _check(self, value, expected, what):
+        if value != expected:
+            self._fail('{} {!r} where the trace has {!r}'.format(what, value, expected))
+
+    def choice(self, genre, song, slot):
+        event = self._expect('g')
+        self._check(slot, event[4], 'put the song in slot')
+        self._done()
+
+    def commit(self, count):
+        event = self._expect('c')
+        self._check(count, event[1], 'committed')
+        self._done()
+
+    def refine(self, order):
+        # Refinement is not repeated, so there is nothing to check
+        self._expect('r')
+        self._done()
+
+def read_trace(f):
+    '''
+    Read a trace written by :py:class:`TraceRecorder`.
+
+    :return: tuple of the header and the list of events
+    '''
+    lines = [line for line in f if line.strip()]
+    if not lines:
+        raise ValueError('Empty trace')
+    return json.loads(lines[0]), [json.loads(line) for line in lines[1:]]
+
+def replay(header, events, backend = None, stats = None):
+    '''
+    Run a recorded generation again, checking that every decision is the
+    same. Refinements are replaced by applying the recorded order.
+
+    :param backend: backend to use instead of the recorded one
+    :param stats: if given, instrumentation is collected into it
+    :type stats: :py:class:`generator.Stats`
+    :return: the generator, once the trace is used up
+    :raise ValueError: at the first decision that differs from the trace
+    '''
+    player = Replay(header, events)
+    if header['window'] != generator.WINDOW:
+        generator.set_window(header['window'])
+    search = None
+    if header.get('search'):
+        mode, count = header['search']
+        search = generator.SlotSearch(mode, count, audit = 0)
+    gen_class = generator.strategies[header['strategy']]
+    gen = gen_class(player.freqs, player.repel, player, player.prefix,
+                    backend or header['backend'], stats, random.Random(header['seed']), player,
+                    search)
+    while player.decisions < len(events):
+        event = events[player.decisions]
+        if event[0] == 'g':
+            gen.step()
+        elif event[0] == 'c':
+            gen.commit(event[1])
+        elif event[0] == 'r':
+            # Draw from the generator as refine would, then apply what it did
+            gen.refine(0, max_moves = 0)
+            if event[1] is not None:
+                gen.reorder(event[1])
+        else:
+            player._fail('unknown event {!r}'.format(event[0]))
+    return gen
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Replay a generation from a trace')
+    parser.add_argument('trace', help = 'trace file written by TraceRecorder')
+    parser.add_argument('--backend', choices = sorted(generator.backends),
+                        help = 'backend to use (default: the one recorded)')
+    parser.add_argument('--profile', action = 'store_true',
+                        help = 'profile the replay and print the most expensive functions')
+    args = parser.parse_args(argv)
+
+    with open(args.trace) as f:
+        header, events = read_trace(f)
+    stats = generator.Stats()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.time()
+    try:
+        replay(header, events, args.backend, stats)
+    except ValueError as e:
+        print('{}: {}'.format(args.trace, e), file = sys.stderr)
+        return 1
+    finally:
+        if profiler is not None:
+            profiler.disable()
+    elapsed = time.time() - start
+    print('{}: {} events replayed identically in {:.3f}s'.format(args.trace, len(events), elapsed))
+    print(stats.report())
+    if profiler is not None:
+        import pstats
+        pstats.Stats(profiler, stream = sys.stdout).sort_stats('cumulative').print_stats(25)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,327 @@
+# LeftFeet: generates a Rhythmbox play queue for social dancing
+# Copyright (C) 2014  Bruce Merry <bmerry@users.sourceforge.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Loads the site configuration from a JSON data file, and compiles it into the
+tables that the rest of LeftFeet uses: the genres, a map from each genre
+string to the set of genres it stands for, and a dense matrix of the
+repulsion between every pair of genres. Compiling is quadratic in the number
+of genres, so the compiled form is cached on disk and only rebuilt when the
+data file changes.
+
+The data file is a JSON object with the following keys:
+
+- `levels`, `groups`: maps from names to numbers, so that genres can give
+  their level and group by name.
+- `genres`: list of genres, each an object with `name`, `level`, `group`,
+  and optionally `energy` (default 0) and `freq`, the default relative
+  frequency (default 20).
+- `aliases`: map from genre strings found in the library to lists of genre
+  names, for strings that are not simply the name of a genre. Matching
+  ignores case, and names that are not genres are ignored.
+- `repel`: list of terms, whose sum gives the repulsion between two genres.
+  Each term is an object with one of the keys below naming a feature
+  (`name`, `family`, `level`, `group` or `energy`), and a `weight`
+  (default 1):
+
+  - `same`: `weight` if the two genres have the same value of the feature
+  - `product`: `weight` times the product of the feature of the two genres
+  - `distance`: `weight` times `base` minus the absolute difference
+    between the feature of the two genres
+
+  The `family` of a genre is the shortest genre name that its name ends
+  with, so that for example Viennese Waltz is in the same family as Waltz.
+  Other keys (such as `comment`) are ignored.
+- `weights`: how likely each song is to be chosen from its genre (see
+  :py:meth:`SiteConfig.song_weight`), an object with any of the keys
+  `rating`, `play_count` and `recency`. Missing keys take the values in
+  :py:data:`DEFAULT_WEIGHTS`.
+'''
+
+import json
+import os
+import pickle
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping   # Python 2
+
+try:
+    from . import generator
+except (ImportError, ValueError):
+    import generator
+
+# Increment when the compiled form changes, to invalidate old caches
+FORMAT = 1
+CACHE_NAME = 'leftfeet-site.cache'
+DEFAULT_WEIGHTS = {'rating': 1.0, 'play_count': 0.5, 'recency': 30.0}
+
+class Genre(object):
+    '''
+    Encapsulates a genre that the generator may produce.
+
+    :ivar int index: position in :py:attr:`SiteConfig.genres`, or `None` if
+      the genre was not created by a :py:class:`SiteConfig`
+    '''
+    def __init__(self, name, level, group, energy = 0):
+        self.name = name
+        self.level = level
+        self.group = group
+        self.energy = energy
+        self.default_freq = 20.0
+        self.index = None
+
+    def __str__(self):
+        return self.name
+
+class RepelTable(Mapping):
+    '''
+    Read-only dictionary of the repulsion between pairs of genres, backed by
+    a dense matrix. It can be used anywhere :py:data:`lf_site.repel` is
+    expected.
+    '''
+    def __init__(self, genres, matrix):
+        self._genres = genres
+        self._matrix = matrix
+
+    def __getitem__(self, pair):
+        a, b = pair
+        try:
+            if self._genres[a.index] is a and self._genres[b.index] is b:
+                return self._matrix[a.index][b.index]
+        except (AttributeError, TypeError, IndexError):
+            pass
+        raise KeyError(pair)
+
+    def __iter__(self):
+        for a in self._genres:
+            for b in self._genres:
+                yield (a, b)
+
+    def __len__(self):
+        return len(self._genres) ** 2
+
+def user_data_dir():
+    '''
+    Return the Rhythmbox user data directory, without needing Rhythmbox if
+    it is not available.
+    '''
+    try:
+        from gi.repository import RB
+        return RB.user_data_dir()
+    except ImportError:
+        base = os.environ.get('XDG_DATA_HOME') or os.path.expanduser(os.path.join('~', '.local', 'share'))
+        return os.path.join(base, 'rhythmbox')
+
+def _family(genre, genres):
+    return min((g.name for g in genres if genre.name.endswith(g.name)), key = len)
+
+def _make_model(data, genres):
+    '''
+    Build a :py:class:`generator.RepulsionModel` from the `repel` terms of
+    the data file.
+    '''
+    families = {g.name: _family(g, genres) for g in genres}
+    features = {
+        'name': lambda g: g.name,
+        'family': lambda g: families[g.name],
+        'level': lambda g: g.level,
+        'group': lambda g: g.group,
+        'energy': lambda g: g.energy
+    }
+    terms = []
+    for spec in data['repel']:
+        weight = spec.get('weight', 1)
+        if 'same' in spec:
+            terms.append(generator.Same(features[spec['same']], weight))
+        elif 'product' in spec:
+            terms.append(generator.Product(features[spec['product']], weight))
+        elif 'distance' in spec:
+            key = features[spec['distance']]
+            values = sorted(set(key(g) for g in genres))
+            table = {(a, b): weight * (spec['base'] - abs(a - b)) for a in values for b in values}
+            terms.append(generator.Lookup(key, table))
+        else:
+            raise ValueError('Unknown repulsion term {!r}'.format(spec))
+    return generator.RepulsionModel(terms)
+
+def _make_genres(data):
+    levels = data.get('levels', {})
+    groups = data.get('groups', {})
+    genres = []
+    for spec in data['genres']:
+        g = Genre(spec['name'],
+                  levels.get(spec['level'], spec['level']),
+                  groups.get(spec['group'], spec['group']),
+                  spec.get('energy', 0))
+        g.default_freq = float(spec.get('freq', g.default_freq))
+        g.index = len(genres)
+        genres.append(g)
+    return genres
+
+def compile_config(data):
+    '''
+    Compile the contents of a data file into the form that is cached. It
+    contains only built-in types, so that loading it is cheap.
+
+    :return: dictionary with the original `data`, the repulsion `matrix`
+      (indexed by position in `data['genres']`) and `sets`, a map from
+      lower-case genre strings to tuples of genre indices
+    '''
+    genres = _make_genres(data)
+    model = _make_model(data, genres)
+    matrix = [[model[(a, b)] for b in genres] for a in genres]
+    index = {g.name.lower(): g.index for g in genres}
+    sets = {name: (i,) for (name, i) in index.items()}
+    for alias, names in data.get('aliases', {}).items():
+        sets[alias.lower()] = tuple(index[x.lower()] for x in names if x.lower() in index)
+    return {'data': data, 'matrix': matrix, 'sets': sets}
+
+class SiteConfig(object):
+    '''
+    Compiled site configuration.
+
+    :ivar list genres: the genres, in the order of the data file
+    :ivar dict genres_by_name: map from name to genre
+    :ivar dict aliases: map from each alias to a list of genre names
+    :ivar list matrix: `matrix[i][j]` is the repulsion between `genres[i]`
+      and `genres[j]`
+    :ivar repel: the repulsion as a dictionary indexed by pairs of genres
+    :vartype repel: :py:class:`RepelTable`
+    :ivar dict weights: parameters for :py:meth:`song_weight`
+    '''
+    def __init__(self, compiled):
+        data = compiled['data']
+        self.genres = _make_genres(data)
+        self.genres_by_name = {g.name: g for g in self.genres}
+        self.aliases = {alias: list(names) for (alias, names) in data.get('aliases', {}).items()}
+        self.matrix = compiled['matrix']
+        self.repel = RepelTable(self.genres, self.matrix)
+        self.weights = dict(DEFAULT_WEIGHTS)
+        self.weights.update(data.get('weights', {}))
+        self._data = data
+        self._model = None
+        self._sets = compiled['sets']
+        self._classified = {}
+
+    @property
+    def model(self):
+        '''
+        The same repulsion as :py:attr:`repel`, broken down into terms (see
+        :py:class:`generator.RepulsionModel`). It is built on first use.
+        '''
+        if self._model is None:
+            self._model = _make_model(self._data, self.genres)
+        return self._model
+
+    def classify(self, name):
+        '''
+        Map the genre string of a song to its genres. Results are remembered
+        for each distinct string.
+
+        :param str name: genre string, as stored in the library
+        :rtype: list of :py:class:`Genre`
+        '''
+        ans = self._classified.get(name)
+        if ans is None:
+            indices = self._sets.get(name.lower(), ())
+            ans = tuple(self.genres[i] for i in indices)
+            self._classified[name] = ans
+        return list(ans)
+
+    def song_weight(self, rating, play_count, last_played, now):
+        '''
+        Return the relative chance of choosing a song over others of the same
+        genre. It is the product of
+
+        - `(1 + rating) ** weights['rating']`, favouring highly rated songs;
+        - `(1 + play_count) ** -weights['play_count']`, favouring songs that
+          have been played less;
+        - `days / (days + weights['recency'])`, where `days` is the time since
+          the song was last played, favouring songs that have not been played
+          for a while (songs that have never been played are not penalised).
+
+        :param float rating: star rating
+        :param int play_count: number of times played
+        :param int last_played: time last played (seconds since the epoch), or
+          0 if never
+        :param now: current time (seconds since the epoch)
+        '''
+        weights = self.weights
+        ans = (1.0 + rating) ** weights['rating'] / (1.0 + play_count) ** weights['play_count']
+        if last_played and weights['recency'] > 0:
+            days = max(0.0, now - last_played) / 86400.0
+            ans *= days / (days + weights['recency'])
+        return ans
+
+def _read_cache(path, source, stat):
+    try:
+        with open(path, 'rb') as f:
+            cached = pickle.load(f)
+    except Exception:
+        # Missing, unreadable or from an incompatible version
+        return None
+    if cached.get('key') != (FORMAT, source, stat.st_mtime, stat.st_size):
+        return None
+    return cached['compiled']
+
+def _write_cache(path, source, stat, compiled):
+    tmp = path + '.tmp'
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(tmp, 'wb') as f:
+            pickle.dump({'key': (FORMAT, source, stat.st_mtime, stat.st_size), 'compiled': compiled},
+                        f, 2)
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        pass    # The cache is only an optimisation
+
+def load(source, cache = None):
+    '''
+    Load a site configuration, using the compiled form in `cache` if it
+    was compiled from the same version of `source`, and otherwise compiling
+    it and updating the cache.
+
+    :param str source: path to the JSON data file
+    :param str cache: path to the cache file, or `None` to not cache
+    :rtype: :py:class:`SiteConfig`
+    '''
+    source = os.path.abspath(source)
+    stat = os.stat(source)
+    compiled = None
+    if cache is not None:
+        compiled = _read_cache(cache, source, stat)
+    if compiled is None:
+        with open(source) as f:
+            compiled = compile_config(json.load(f))
+        if cache is not None:
+            _write_cache(cache, source, stat, compiled)
+    return SiteConfig(compiled)
+
+def find(name, directories):
+    '''
+    Return the path to the first file called `name` in `directories`, or
+    `None` if there is none.
+    '''
+    for directory in directories:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+__all__ = ['Genre', 'RepelTable', 'SiteConfig', 'compile_config', 'load', 'find', 'user_data_dir']
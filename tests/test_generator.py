@@ -0,0 +1,64 @@
+# LeftFeet: generates a Rhythmbox play queue for social dancing
+# Copyright (C) 2014  Bruce Merry <bmerry@users.sourceforge.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division, print_function
+
+import os
+import random
+import sys
+import unittest
+
+# The modules are imported directly, since the package needs Rhythmbox
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'leftfeet'))
+import generator
+
+class TestGenreQueue(unittest.TestCase):
+    def check_gap(self, freqs, n, rng):
+        freqs = generator._normalize(freqs)
+        queue = generator.GenreQueue(dict(freqs), None, rng)
+        for N in range(1, n + 1):
+            queue.advance()
+            for g, f in freqs.items():
+                self.assertLess(abs(queue.seen[g] - N * f), 1.0)
+
+    def test_skewed(self):
+        freqs = {g: 1.0 for g in 'abcdefghijkl'}
+        freqs['a'] = 5.0
+        self.check_gap(freqs, 500, random.Random(1))
+
+    def test_random(self):
+        rng = random.Random(2)
+        for trial in range(200):
+            genres = 'abcdefghijkl'[:rng.randint(1, 12)]
+            freqs = {g: rng.choice([0.5, 1.0, 2.0, 5.0, 10 * rng.random() + 0.01]) for g in genres}
+            self.check_gap(freqs, 200, rng)
+
+    def test_restore(self):
+        freqs = generator._normalize({'a': 3.0, 'b': 1.0, 'c': 1.0})
+        genres = sorted(freqs)
+        queue = generator.GenreQueue(dict(freqs), None, random.Random(3))
+        for i in range(7):
+            queue.advance()
+        state = queue.get_state({g: i for (i, g) in enumerate(genres)})
+        copy = generator.GenreQueue.restore(dict(freqs), dict(queue.seen), state, genres, random.Random(4))
+        queue.rng = random.Random(4)
+        for i in range(20):
+            self.assertEqual(queue.peek(), copy.peek())
+            queue.advance()
+            copy.advance()
+
+if __name__ == '__main__':
+    unittest.main()